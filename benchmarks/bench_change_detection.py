@@ -0,0 +1,97 @@
+import os
+import sys
+import time
+import argparse
+import cv2
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from change_detector import ShelfChangeDetector
+from synthetic_shelf import make_shelf
+
+
+def drift_homography(image_size, scale=None, shift=None, angle=None):
+    
+    if scale is None:
+        scale = 1.0
+    if shift is None:
+        shift = (0, 0)
+    if angle is None:
+        angle = 0.0
+    
+    # 画像中心まわりの回転・拡大と平行移動（手持ち撮影の位置ずれを想定）
+    width, height = image_size
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, scale)
+    matrix[:, 2] += shift
+    return np.vstack([matrix, [0, 0, 1]])
+
+
+def run_case(change_detector, image, layout, homography):
+    
+    current = Image.fromarray(cv2.warpPerspective(np.asarray(image), homography, image.size))
+    
+    start = time.perf_counter()
+    estimated = change_detector.align(image, current)
+    if estimated is None:
+        return None
+    regions = change_detector.find_changed_regions(image, current, estimated)
+    elapsed = time.perf_counter() - start
+    
+    # 変化のない棚なので、全物体が引き継がれるのが理想
+    state = {"objects": [{"box": obj["box"]} for obj in layout["products"] + layout["tags"]]}
+    carried = change_detector.carry_over_objects(state, estimated, regions, current.size)
+    area = sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in regions)
+    
+    return {
+        "regions": len(regions),
+        "region_area_ratio": area / (image.size[0] * image.size[1]),
+        "carried": len(carried),
+        "objects": len(state["objects"]),
+        "seconds": elapsed
+    }
+
+
+def main():
+    
+    parser = argparse.ArgumentParser(description="撮影位置のずれだけの棚画像で差分検出の変化領域と引き継ぎ数を確認")
+    parser.add_argument("--width", type=int, default=2304)
+    parser.add_argument("--height", type=int, default=1728)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    
+    image, layout = make_shelf((args.width, args.height), seed=args.seed)
+    change_detector = ShelfChangeDetector()
+    
+    # (名前, 変換, 変化領域なしを必須とするか)
+    cases = [
+        ("identity", drift_homography(image.size), True),
+        ("scale0.2%+shift3px", drift_homography(image.size, scale=1.002, shift=(3, 3)), True),
+        ("rotate0.3deg", drift_homography(image.size, angle=0.3), False),
+        ("rotate0.57deg", drift_homography(image.size, angle=0.57), False),
+        ("shift40px", drift_homography(image.size, shift=(40, 0)), False)
+    ]
+    
+    failures = []
+    for name, homography, expect_no_regions in cases:
+        result = run_case(change_detector, image, layout, homography)
+        if result is None:
+            print(f"  {name:<20} 位置合わせ失敗")
+            failures.append(name)
+            continue
+        print(
+            f"  {name:<20} 変化領域 {result['regions']}個 ({result['region_area_ratio']:.1%}), "
+            f"引き継ぎ {result['carried']}/{result['objects']}, {result['seconds'] * 1000:.0f}ms"
+        )
+        if expect_no_regions and result["regions"] > 0:
+            failures.append(name)
+    
+    if failures:
+        print(f"\nずれのみの画像で変化領域が検出されました: {', '.join(failures)}")
+        sys.exit(1)
+    print("\nずれのみの画像で変化領域は検出されませんでした")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from detection_set import DetectionSet
+
+
+def make_image_and_boxes(image_size, object_count, seed=0):
+    
+    rng = np.random.default_rng(seed)
+    width, height = image_size
+    
+    # ノイズ入りの大きな画像（圧縮の効かない実写に近い負荷）
+    image = Image.fromarray(rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8))
+    
+    sizes = rng.uniform(0.02, 0.15, size=(object_count, 2)) * [width, height]
+    origins = rng.uniform(0, 1, size=(object_count, 2)) * ([width, height] - sizes)
+    boxes = np.concatenate([origins, origins + sizes], axis=1).astype(np.float32)
+    scores = rng.uniform(0.18, 0.9, size=object_count).astype(np.float32)
+    labels = ["a product" if i % 2 == 0 else "a tag" for i in range(object_count)]
+    
+    return image, boxes, scores, labels
+
+
+def peak_rss_mb():
+    # Linuxではキロバイト単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_mode(mode, image_size, object_count, used_ratio):
+    
+    image, boxes, scores, labels = make_image_and_boxes(image_size, object_count)
+    used_rows = np.arange(int(object_count * used_ratio))
+    baseline_rss = peak_rss_mb()
+    
+    start = time.perf_counter()
+    checksum = 0
+    if mode == "eager":
+        # 従来の方式: 全ての検出について切り出し画像を作成して保持
+        crops = [image.crop(tuple(int(v) for v in box)) for box in boxes]
+        for row in used_rows:
+            checksum += int(np.asarray(crops[row])[0, 0, 0])
+    else:
+        # 共有バッファ上の遅延切り出し: 使われる検出のみ画素を参照
+        # 共有バッファが画素を保持するので、呼び出し側のPIL画像は手放す（main.pyと同じ）
+        detections = DetectionSet(image, boxes, scores, labels)
+        image = None
+        for row in used_rows:
+            checksum += int(np.asarray(detections.crop(row))[0, 0, 0])
+        detections.release_image()
+    elapsed = time.perf_counter() - start
+    
+    return {
+        "mode": mode,
+        "image_size": list(image_size),
+        "objects": object_count,
+        "used_ratio": used_ratio,
+        "seconds": elapsed,
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_rss_increase_mb": peak_rss_mb() - baseline_rss,
+        "checksum": checksum
+    }
+
+
+def main():
+    
+    parser = argparse.ArgumentParser(description="切り出し処理の時間とピークメモリ(RSS)を計測")
+    parser.add_argument("--width", type=int, default=8000)
+    parser.add_argument("--height", type=int, default=6000)
+    parser.add_argument("--objects", type=int, default=1000)
+    parser.add_argument("--used-ratio", type=float, default=0.3)
+    parser.add_argument("--mode", choices=["eager", "lazy"])
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+    
+    image_size = (args.width, args.height)
+    
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, image_size, args.objects, args.used_ratio)))
+        return
+    
+    # ピークRSSはプロセス単位なので方式ごとに別プロセスで計測
+    results = []
+    for mode in ("eager", "lazy"):
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--mode", mode,
+             "--width", str(args.width), "--height", str(args.height),
+             "--objects", str(args.objects), "--used-ratio", str(args.used_ratio)],
+            capture_output=True, text=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        results.append(result)
+        print(f"{mode:>5}: {result['seconds']:.3f}秒, ピークRSS増加 {result['peak_rss_increase_mb']:.1f}MB")
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
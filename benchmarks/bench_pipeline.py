@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import logging
+import argparse
+import tempfile
+import statistics
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from perf import recorder
+from detection_set import PRODUCT, TAG
+from result_writer import ResultWriter
+from synthetic_shelf import make_catalog, make_shelf, render_product_face
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 実モデルの配置場所（main.pyと同じく実行ディレクトリからの相対パス）
+MODEL_DIRS = ["models/grounding-dino-base", "models/siglip-base-patch16-224"]
+
+TEXT_PROMPT = "a product. a tag."
+
+# pyzbar（zbarのビルド）に依存するため、共有のベースラインには保存しない精度の項目
+BARCODE_METRICS = ("barcode_verified", "tags_decoded")
+
+
+def models_available():
+    return all(os.path.isdir(path) for path in MODEL_DIRS)
+
+
+def build_detector(mode, layout):
+    
+    from main import DrugstoreDetector
+    
+    if mode == "real":
+        return DrugstoreDetector()
+    
+    from stubs import StubObjectDetector, StubSigLIPClassifier, StubOCRReader
+    return DrugstoreDetector(
+        object_detector=StubObjectDetector(layout),
+        siglip_classifier=StubSigLIPClassifier(),
+        ocr_reader=StubOCRReader()
+    )
+
+
+def box_iou(boxes, box):
+    
+    x1 = np.maximum(boxes[:, 0], box[0])
+    y1 = np.maximum(boxes[:, 1], box[1])
+    x2 = np.minimum(boxes[:, 2], box[2])
+    y2 = np.minimum(boxes[:, 3], box[3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return intersection / (areas + (box[2] - box[0]) * (box[3] - box[1]) - intersection)
+
+
+def evaluate(layout, detections, matched_products, tag_codes):
+    
+    # 検出画像の座標系に合わせた正解の商品
+    scale = detections.image_size[0] / layout["image_size"][0]
+    truth_boxes = np.array([product["box"] for product in layout["products"]], dtype=np.float32) * scale
+    truth_names = [product["name"] for product in layout["products"]]
+    target = layout["target_name"]
+    
+    # 一致した商品をIoUが最大の正解に対応付ける
+    true_positives = 0
+    for item in matched_products:
+        iou = box_iou(truth_boxes, item["box"])
+        best = int(iou.argmax())
+        if iou[best] >= 0.5 and truth_names[best] == target:
+            true_positives += 1
+    
+    expected = truth_names.count(target)
+    valid_codes = {tag["barcode"] for tag in layout["tags"]}
+    
+    return {
+        "products": int(len(detections.rows(PRODUCT))),
+        "tags": int(len(detections.rows(TAG))),
+        "pairs": int((detections.pair_index >= 0).sum()),
+        "matched": len(matched_products),
+        "match_precision": true_positives / len(matched_products) if matched_products else 0.0,
+        "match_recall": true_positives / expected if expected else 0.0,
+        "barcode_verified": sum(1 for item in matched_products if item.get("barcode_verified") is True),
+        "tags_decoded": sum(1 for code in tag_codes if code in valid_codes)
+    }
+
+
+def run_once(detector, image_path, layout, work_dir, preview_max_size=None):
+    
+    recorder.reset()
+    
+    with recorder.stage("pipeline"):
+        results = detector.object_detector.detect_objects(image_path, TEXT_PROMPT, threshold=0.18)
+        
+        detections = detector.object_detector.crop_detected_objects(
+            results,
+            output_dir=os.path.join(work_dir, "cropped"),
+            max_width_ratio=0.8,
+            max_height_ratio=0.8
+        )
+        
+        with recorder.stage("session"):
+            session = detector.create_session(detections)
+        with recorder.stage("search"):
+            processed_results, matched_products, pairing_result = session.search(layout["target_name"])
+        
+        with recorder.stage("visualize"):
+            detector.visualizer.render(
+                detections,
+                [item for item in matched_products if item.get("barcode_verified") is True],
+                save_path=os.path.join(work_dir, "result.jpeg"),
+                max_size=preview_max_size
+            )
+        
+        detector.save_results_to_json(processed_results, os.path.join(work_dir, "results.json"))
+        with ResultWriter(os.path.join(work_dir, "results.ndjson")) as writer:
+            writer.write(image_path, processed_results)
+    
+    # 全タグのバーコード読み取り（元解像度の切り出しから）
+    tag_codes = []
+    with recorder.stage("barcode.all_tags"):
+        for row in detections.rows(TAG):
+            codes = detector.barcode_reader.detect_barcode_from_image(detections.crop(row, full_resolution=True))
+            tag_codes.append(codes[0] if codes else None)
+    
+    detections.release_image()
+    return recorder.report(), evaluate(layout, detections, matched_products, tag_codes)
+
+
+def summarize(reports):
+    
+    # 各ステージの合計時間の中央値
+    names = sorted({name for report in reports for name in report["stages"]})
+    return {
+        name: statistics.median(report["stages"].get(name, {"seconds": 0.0})["seconds"] for report in reports)
+        for name in names
+    }
+
+
+def compare(current, baseline, tolerance, min_delta):
+    
+    regressions = []
+    
+    # 処理時間はマシンに依存するため、精度のみのベースラインでは比較しない
+    for name, seconds in current["stages"].items():
+        base = baseline.get("stages", {}).get(name)
+        if base is None:
+            continue
+        if seconds > base * (1 + tolerance) and seconds - base > min_delta:
+            regressions.append(f"{name}: {base * 1000:.1f}ms → {seconds * 1000:.1f}ms (+{(seconds / base - 1):.0%})")
+    
+    # 精度（検出数・一致数など）が変わった場合も回帰として報告
+    for name, value in baseline["quality"].items():
+        if current["quality"].get(name) != value:
+            regressions.append(f"{name}: {value} → {current['quality'].get(name)}")
+    
+    return regressions
+
+
+def main():
+    
+    parser = argparse.ArgumentParser(description="合成した棚画像でパイプライン全体の処理時間を計測")
+    parser.add_argument("--mode", choices=["stub", "real", "auto"], default="stub",
+                        help="stub: モデルを使わない / real: 実モデル / auto: モデルがあればreal")
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--rows", type=int, default=4)
+    parser.add_argument("--columns", type=int, default=8)
+    parser.add_argument("--products", type=int, default=6)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--portable", action="store_true",
+                        help="--update-baselineで処理時間とバーコード読み取りの結果を除いて保存（リポジトリで共有する場合）")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--min-delta", type=float, default=0.005)
+    parser.add_argument("--preview-max-size", type=int, default=None)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=os.environ.get("DETECT_LOG_LEVEL", "WARNING"), format="%(message)s")
+    
+    mode = args.mode
+    if mode == "auto":
+        mode = "real" if models_available() else "stub"
+    if mode == "real" and not models_available():
+        parser.error(f"モデルが見つかりません: {', '.join(MODEL_DIRS)}")
+    
+    baseline_path = args.baseline
+    if baseline_path is None:
+        baseline_path = os.path.join(BENCHMARK_DIR, "baselines", f"pipeline_{mode}.json")
+    
+    config = {
+        "image_size": [args.width, args.height],
+        "rows": args.rows,
+        "columns": args.columns,
+        "products": args.products,
+        "seed": args.seed,
+        "preview_max_size": args.preview_max_size
+    }
+    
+    with tempfile.TemporaryDirectory() as work_dir:
+        # 合成画像と参照画像を作成
+        catalog = make_catalog(args.products, seed=args.seed)
+        image, layout = make_shelf((args.width, args.height), args.rows, args.columns, catalog, seed=args.seed)
+        image_path = os.path.join(work_dir, "shelf.jpeg")
+        image.save(image_path, quality=95)
+        
+        detector = build_detector(mode, layout)
+        for item in catalog:
+            reference_path = os.path.join(work_dir, f"{item['name']}.png")
+            render_product_face(item["name"], (300, 400)).save(reference_path)
+            detector.register_product(item["name"], reference_path, item["barcode"])
+        
+        # 1回目はウォームアップとして除外
+        run_once(detector, image_path, layout, work_dir, args.preview_max_size)
+        reports = []
+        for _ in range(args.repeat):
+            report, quality = run_once(detector, image_path, layout, work_dir, args.preview_max_size)
+            reports.append(report)
+    
+    current = {
+        "mode": mode,
+        "config": config,
+        "repeat": args.repeat,
+        "stages": summarize(reports),
+        "counters": reports[-1]["counters"],
+        "quality": quality
+    }
+    
+    print(f"モード: {mode}, 画像: {args.width}x{args.height}, 商品: {len(layout['products'])}個")
+    for name, seconds in current["stages"].items():
+        print(f"  {name:<24} {seconds * 1000:9.1f}ms")
+    print("  精度: " + ", ".join(f"{name}={value:.2f}" if isinstance(value, float) else f"{name}={value}"
+                                for name, value in quality.items()))
+    
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+    
+    if args.update_baseline:
+        baseline = current
+        if args.portable:
+            # スタブの精度は決定的だが、処理時間とバーコード読み取りはマシン・ライブラリに依存する
+            baseline = {
+                "mode": mode,
+                "config": config,
+                "quality": {name: value for name, value in quality.items() if name not in BARCODE_METRICS}
+            }
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+        print(f"ベースラインを更新: {baseline_path}")
+        return
+    
+    if not os.path.exists(baseline_path):
+        print(f"ベースラインがありません（--update-baselineで作成）: {baseline_path}")
+        return
+    
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    
+    # 設定が異なると全ての差が回帰に見えるため比較しない
+    if baseline["mode"] != mode or baseline["config"] != config:
+        print(f"ベースラインと設定が異なるため比較しません: {baseline_path}")
+        print(f"  ベースライン: {baseline['mode']} {baseline['config']}")
+        print(f"  今回: {mode} {config}")
+        print("  同じ設定で実行するか、--baselineで別のファイルを指定してください")
+        sys.exit(2)
+    
+    regressions = compare(current, baseline, args.tolerance, args.min_delta)
+    if regressions:
+        print("\n回帰を検出:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    print("\nベースラインからの回帰はありません")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import numpy as np
+from PIL import Image
+from object_detector import ObjectDetector
+from classifier import SigLIPClassifier
+from profiling import Profiler
+from perf import recorder
+
+
+class StubObjectDetector(ObjectDetector):
+    
+    def __init__(self, layout, jitter=None, unlabeled_every=None, noise_count=None, seed=None):
+        
+        # モデルは読み込まず、合成画像の配置から検出結果を作る
+        if jitter is None:
+            jitter = 0.02
+        if unlabeled_every is None:
+            unlabeled_every = 7
+        if noise_count is None:
+            noise_count = 100
+        if seed is None:
+            seed = 0
+        
+        self.device = "cpu"
+        self.model_id = None
+        self.reduced_decode = True
+        self.profiler = Profiler()
+        
+        self.layout = layout
+        self.jitter = jitter
+        self.unlabeled_every = unlabeled_every
+        self.noise_count = noise_count
+        self.seed = seed
+    
+    def detect_raw_in_image(self, image, text_prompt):
+        
+        # 呼び出しごとに同じ結果になるよう毎回同じ乱数列を使う
+        rng = np.random.default_rng(self.seed)
+        width, height = self.layout["image_size"]
+        scale = image.size[0] / width
+        
+        boxes = []
+        labels = []
+        for i, product in enumerate(self.layout["products"]):
+            boxes.append(product["box"])
+            # 一部はラベルなしにしてSigLIPでの分類を通す
+            labels.append("" if self.unlabeled_every and i % self.unlabeled_every == 0 else "a product")
+        for tag in self.layout["tags"]:
+            boxes.append(tag["box"])
+            labels.append("a tag")
+        
+        # 棚全体を1つの商品とする誤検出（サイズ比のフィルタで除外される）
+        boxes.append([0, 0, width * 0.95, height * 0.9])
+        labels.append("a product")
+        
+        with recorder.stage("detect.postprocess"):
+            boxes = np.array(boxes, dtype=np.float32)
+            sizes = np.concatenate([boxes[:, 2:] - boxes[:, :2]] * 2, axis=1)
+            boxes = boxes + rng.uniform(-self.jitter, self.jitter, size=boxes.shape) * sizes
+            scores = rng.uniform(0.2, 0.9, size=len(boxes))
+            
+            # 低スコアの誤検出クエリ（閾値を下げると混ざる）
+            origins = rng.uniform(0, 0.9, size=(self.noise_count, 2)) * [width, height]
+            noise = np.concatenate([origins, origins + rng.uniform(0.03, 0.1, size=(self.noise_count, 2)) * [width, height]], axis=1)
+            boxes = np.concatenate([boxes, noise]) * scale
+            boxes = np.clip(boxes, 0, [image.size[0], image.size[1], image.size[0], image.size[1]]).astype(np.float32)
+            scores = np.concatenate([scores, rng.uniform(0.01, 0.22, size=self.noise_count)]).astype(np.float32)
+            labels += [("a product", "a tag")[i % 2] for i in range(self.noise_count)]
+        
+        return {
+            "image": image,
+            "boxes": boxes,
+            "scores": scores,
+            "labels": labels
+        }
+    
+    def detect_objects_in_image(self, image, text_prompt, threshold=None):
+        
+        if threshold is None:
+            threshold = 0.18
+        
+        results = self.detect_raw_in_image(image, text_prompt)
+        keep = results["scores"] > threshold
+        recorder.count("detections", int(keep.sum()))
+        
+        return {
+            "image": image,
+            "boxes": results["boxes"][keep],
+            "scores": results["scores"][keep],
+            "labels": [label for label, kept in zip(results["labels"], keep) if kept]
+        }
+
+
+class StubSigLIPClassifier(SigLIPClassifier):
+    
+    def __init__(self, grid_size=None):
+        
+        # 縮小画像の画素を特徴量とする決定的な埋め込み
+        if grid_size is None:
+            grid_size = 8
+        
+        self.device = "cpu"
+        self.model_id = None
+        self.match_threshold = 0.7
+        self.profiler = Profiler()
+        self.grid_size = grid_size
+    
+    def encode_images(self, images, batch_size=None):
+        
+        features = np.zeros((len(images), self.grid_size * self.grid_size * 3), dtype=np.float32)
+        with recorder.stage("siglip.forward"):
+            for i, image in enumerate(images):
+                pixels = np.asarray(
+                    self._load_image(image).resize((self.grid_size, self.grid_size), Image.Resampling.BOX),
+                    dtype=np.float32
+                ).ravel()
+                pixels -= pixels.mean()
+                features[i] = pixels / max(np.linalg.norm(pixels), 1e-6)
+        recorder.count("siglip_images", len(images))
+        return features
+    
+    def classify_image(self, image_path, return_probs=False):
+        
+        # 縦長ならproduct、横長ならtag
+        width, height = self._load_image(image_path).size
+        product = height / (width + height)
+        class_name = "product" if product >= 0.5 else "tag"
+        recorder.count("siglip_images")
+        
+        if return_probs:
+            return class_name, {
+                "product": product,
+                "tag": 1 - product,
+                "product_score": product,
+                "tag_score": 1 - product
+            }
+        return class_name
+
+
+class StubOCRReader:
+    
+    # EasyOCRと同じインターフェース（文字は検出しない）
+    def readtext(self, image):
+        return []
@@ -0,0 +1,418 @@
+import io
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import itertools
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from detection_set import DetectionSet, FullResolutionSource, PRODUCT, TAG, UNCLASSIFIED
+from pairing import ProductTagPairing
+from box_filter import box_sizes, clip_boxes, prefilter_boxes
+from bench_pipeline import MODEL_DIRS, TEXT_PROMPT, box_iou, build_detector, models_available
+from synthetic_shelf import make_catalog, make_shelf, render_product_face
+
+# main.pyの既定値（比較用に必ず評価する）
+DEFAULT_CONFIG = {"threshold": 0.18, "match_threshold": 0.7, "max_pairing_distance": 300, "size_ratio": 0.8}
+
+# 評価では固定する切り出し前の絞り込み（main.pyの既定値）
+MIN_BOX_SIZE = 8
+NMS_IOU_THRESHOLD = 0.7
+
+# キャッシュの形式を変えたら更新する（古いキャッシュを使わない）
+CACHE_VERSION = 4
+
+
+def parse_values(text, cast=float):
+    return [cast(value) for value in text.split(",") if value]
+
+
+def load_labels(labels_path):
+    
+    with open(labels_path, 'r', encoding='utf-8') as f:
+        labels = json.load(f)
+    
+    # 画像・参照画像のパスはラベルファイルからの相対パス
+    base_dir = os.path.dirname(os.path.abspath(labels_path))
+    for entry in labels["images"]:
+        entry["image_path"] = os.path.join(base_dir, entry["image_path"])
+    for product in labels["products"].values():
+        product["image_path"] = os.path.join(base_dir, product["image_path"])
+    return labels
+
+
+def write_synthetic_labels(output_dir, image_count, seed):
+    
+    # 合成の棚画像から正解つきの評価セットを作成
+    os.makedirs(output_dir, exist_ok=True)
+    catalog = make_catalog(6, seed=seed)
+    labels = {"products": {}, "images": []}
+    
+    for item in catalog:
+        filename = f"{item['name']}.png"
+        render_product_face(item["name"], (300, 400)).save(os.path.join(output_dir, filename))
+        labels["products"][item["name"]] = {"image_path": filename, "barcode": item["barcode"]}
+    
+    for i in range(image_count):
+        image, layout = make_shelf(catalog=catalog, target_name=catalog[i % len(catalog)]["name"], seed=seed + i)
+        filename = f"shelf_{i + 1:03d}.jpeg"
+        image.save(os.path.join(output_dir, filename), quality=95)
+        labels["images"].append({**layout, "image_path": filename})
+    
+    labels_path = os.path.join(output_dir, "labels.json")
+    with open(labels_path, 'w', encoding='utf-8') as f:
+        json.dump(labels, f, ensure_ascii=False, indent=2)
+    return labels_path
+
+
+def cache_key(image_path, object_detector, siglip_classifier, text_prompt):
+    
+    digest = hashlib.sha1()
+    with open(image_path, 'rb') as f:
+        digest.update(f.read())
+    digest.update(json.dumps([
+        CACHE_VERSION,
+        text_prompt,
+        type(object_detector).__name__, object_detector.model_id, object_detector.reduced_decode,
+        type(siglip_classifier).__name__, siglip_classifier.model_id
+    ]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def build_cache(entry, object_detector, siglip_classifier, barcode_reader, text_prompt, cache_dir, min_threshold):
+    
+    cache_path = os.path.join(cache_dir, cache_key(entry["image_path"], object_detector, siglip_classifier, text_prompt) + ".npz")
+    if os.path.exists(cache_path):
+        cache = dict(np.load(cache_path))
+        # 今回の最小閾値までの埋め込みがあれば再利用
+        if cache["min_threshold"] <= min_threshold:
+            return cache
+    
+    start = time.perf_counter()
+    image = object_detector.load_image(entry["image_path"])
+    decode_seconds = time.perf_counter() - start
+    with Image.open(entry["image_path"]) as original:
+        original_width = original.size[0]
+    
+    # 閾値で絞り込む前のGrounding DINOの出力
+    start = time.perf_counter()
+    raw = object_detector.detect_raw_in_image(image, text_prompt)
+    detect_seconds = time.perf_counter() - start
+    
+    # 最小閾値を超えるクエリのみ分類と埋め込みを計算
+    # 画像端のクエリは座標が画像外にはみ出すため、パイプラインと同じく先に補正して小さすぎるものを除く
+    boxes = clip_boxes(np.asarray(raw["boxes"], dtype=np.float32).reshape(-1, 4), image.size)
+    widths, heights = box_sizes(boxes)
+    keep = (raw["scores"] > min_threshold) & (widths >= MIN_BOX_SIZE) & (heights >= MIN_BOX_SIZE)
+    labels = [label for label, kept in zip(raw["labels"], keep) if kept]
+    detections = DetectionSet(image, boxes[keep], raw["scores"][keep], labels)
+    
+    # Grounding DINOのラベルで分類できなかった行（SigLIPの分類で書き換える前に記録）
+    unlabeled = detections.class_ids == UNCLASSIFIED
+    unclassified_rows = detections.rows(UNCLASSIFIED)
+    start = time.perf_counter()
+    for row in unclassified_rows:
+        if siglip_classifier.classify_image(detections.crop(row)) == 'product':
+            detections.class_ids[row] = PRODUCT
+    classify_seconds = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    embeddings = siglip_classifier.encode_images([detections.crop(row) for row in range(len(detections))])
+    embed_seconds = time.perf_counter() - start
+    
+    # 切り出しの保存（PNGへの書き出し）の1個あたりの時間
+    start = time.perf_counter()
+    for row in range(len(detections)):
+        detections.crop(row).convert().save(io.BytesIO(), format="PNG")
+    crop_seconds = time.perf_counter() - start
+    
+    # タグごとのバーコード読み取り（OCRフォールバックを含む）の時間と、元解像度のデコード時間
+    # （一致した商品のペアのタグのみ読み取るため、設定ごとに対象のタグの分を合計する）
+    tag_rows = detections.rows(TAG, include_filtered=True)
+    detections.full_resolution = FullResolutionSource(entry["image_path"], image.size)
+    start = time.perf_counter()
+    detections.full_resolution.crop_rows(tag_rows, detections.boxes)
+    full_resolution_seconds = time.perf_counter() - start
+    
+    barcode_seconds = np.zeros(len(detections), dtype=np.float64)
+    for row in tag_rows:
+        start = time.perf_counter()
+        barcode_reader.read_barcode(detections.crop(row, full_resolution=True))
+        barcode_seconds[row] = time.perf_counter() - start
+    
+    cache = {
+        "boxes": detections.boxes,
+        "scores": detections.scores,
+        "labels": np.array(labels, dtype=str),
+        "class_ids": detections.class_ids,
+        "unlabeled": unlabeled,
+        "embeddings": embeddings,
+        "image_size": np.array(image.size),
+        "scale": np.float32(image.size[0] / original_width),
+        "min_threshold": np.float32(min_threshold),
+        "decode_seconds": np.float64(decode_seconds),
+        "detect_seconds": np.float64(detect_seconds),
+        "classify_seconds_per_crop": np.float64(classify_seconds / max(len(unclassified_rows), 1)),
+        "embed_seconds_per_crop": np.float64(embed_seconds / max(len(detections), 1)),
+        "crop_seconds_per_crop": np.float64(crop_seconds / max(len(detections), 1)),
+        "full_resolution_seconds": np.float64(full_resolution_seconds),
+        "barcode_seconds": barcode_seconds
+    }
+    os.makedirs(cache_dir, exist_ok=True)
+    np.savez(cache_path, **cache)
+    return cache
+
+
+def assign_to_truth(boxes, scores, truth_boxes, iou_threshold=None):
+    
+    if iou_threshold is None:
+        iou_threshold = 0.5
+    
+    # スコアの高い順に、IoUが最大の未対応の正解へ1対1で対応付ける
+    assigned = np.full(len(boxes), -1, dtype=np.int64)
+    if len(truth_boxes) == 0:
+        return assigned
+    used = np.zeros(len(truth_boxes), dtype=bool)
+    for i in np.argsort(-scores):
+        iou = np.where(used, 0.0, box_iou(truth_boxes, boxes[i]))
+        best = int(iou.argmax())
+        if iou[best] >= iou_threshold:
+            assigned[i] = best
+            used[best] = True
+    return assigned
+
+
+def evaluate_image(cache, entry, reference_embedding, grid):
+    
+    # 正解を検出画像の座標系に合わせる
+    scale = float(cache["scale"])
+    truth_products = np.array([product["box"] for product in entry["products"]], dtype=np.float32).reshape(-1, 4) * scale
+    truth_tags = np.array([tag["box"] for tag in entry["tags"]], dtype=np.float32).reshape(-1, 4) * scale
+    truth_names = [product["name"] for product in entry["products"]]
+    truth_pairs = {tuple(pair) for pair in entry.get("pairs", [])}
+    target_count = truth_names.count(entry["target_name"])
+    
+    image_size = tuple(int(v) for v in cache["image_size"])
+    labels = [str(label) for label in cache["labels"]]
+    results = {}
+    
+    for threshold, size_ratio in itertools.product(grid["threshold"], grid["size_ratio"]):
+        above = np.flatnonzero(cache["scores"] > threshold)
+        start = time.perf_counter()
+        
+        # crop_detected_objectsと同じ切り出し前の絞り込み
+        boxes, keep, too_large, _ = prefilter_boxes(
+            cache["boxes"][above],
+            cache["scores"][above],
+            cache["class_ids"][above],
+            image_size,
+            size_ratio,
+            size_ratio,
+            MIN_BOX_SIZE,
+            NMS_IOU_THRESHOLD
+        )
+        selected = above[keep]
+        
+        detections = DetectionSet(
+            None,
+            boxes[keep],
+            cache["scores"][selected],
+            [labels[i] for i in selected],
+            class_ids=cache["class_ids"][selected],
+            filtered=too_large[keep],
+            image_size=image_size
+        )
+        embeddings = cache["embeddings"][selected]
+        
+        product_rows = detections.rows(PRODUCT)
+        tag_rows = detections.rows(TAG)
+        similarities = embeddings[product_rows] @ reference_embedding
+        base_seconds = time.perf_counter() - start
+        
+        # 検出を正解に対応付け（処理時間には含めない）
+        product_truth = assign_to_truth(detections.boxes[product_rows], detections.scores[product_rows], truth_products)
+        tag_truth = assign_to_truth(detections.boxes[tag_rows], detections.scores[tag_rows], truth_tags)
+        tag_truth_by_row = dict(zip(tag_rows.tolist(), tag_truth.tolist()))
+        
+        # デコード・モデル・切り出しの保存はキャッシュ作成時の実測から推定
+        model_seconds = (
+            float(cache["decode_seconds"])
+            + float(cache["detect_seconds"])
+            + int((cache["unlabeled"][selected] & detections.active).sum()) * float(cache["classify_seconds_per_crop"])
+            + len(product_rows) * float(cache["embed_seconds_per_crop"])
+            + len(detections.rows()) * float(cache["crop_seconds_per_crop"])
+        )
+        barcode_seconds = cache["barcode_seconds"][selected]
+        
+        for max_pairing_distance in grid["max_pairing_distance"]:
+            start = time.perf_counter()
+            pairs = ProductTagPairing(max_pairing_distance=max_pairing_distance).pair_products_and_tags(detections)['pairs']
+            pairing_seconds = time.perf_counter() - start
+            
+            product_truth_by_row = dict(zip(product_rows.tolist(), product_truth.tolist()))
+            correct_pairs = sum(
+                1 for product_row, tag_row in pairs
+                if (product_truth_by_row[product_row], tag_truth_by_row[tag_row]) in truth_pairs
+            )
+            
+            # 商品の行 → ペアのタグの行（最初に見つかったペアを優先、session.pyと同じ）
+            tag_by_product = {}
+            for product_row, tag_row in pairs:
+                tag_by_product.setdefault(int(product_row), int(tag_row))
+            
+            for match_threshold in grid["match_threshold"]:
+                matched = similarities >= match_threshold
+                correct_matches = sum(
+                    1 for truth in product_truth[matched]
+                    if truth >= 0 and truth_names[truth] == entry["target_name"]
+                )
+                
+                # 一致した商品のペアのタグのみバーコードを読み取る（同じタグは1回、元解像度のデコードも1回）
+                read_tags = {tag_by_product[row] for row in product_rows[matched].tolist() if row in tag_by_product}
+                verify_seconds = sum(barcode_seconds[row] for row in read_tags)
+                if read_tags:
+                    verify_seconds += float(cache["full_resolution_seconds"])
+                
+                results[(threshold, match_threshold, max_pairing_distance, size_ratio)] = {
+                    "detection": (int((product_truth >= 0).sum() + (tag_truth >= 0).sum()),
+                                  len(product_rows) + len(tag_rows), len(truth_products) + len(truth_tags)),
+                    "pairing": (correct_pairs, len(pairs), len(truth_pairs)),
+                    "match": (correct_matches, int(matched.sum()), target_count),
+                    "seconds": model_seconds + base_seconds + pairing_seconds + verify_seconds
+                }
+    
+    return results
+
+
+def precision_recall(correct, predicted, expected):
+    
+    precision = correct / predicted if predicted else 0.0
+    recall = correct / expected if expected else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {"precision": precision, "recall": recall, "f1": f1}
+
+
+def aggregate(per_image):
+    
+    # 画像ごとの件数を合計してから適合率・再現率を計算
+    configs = []
+    for key in per_image[0]:
+        totals = {metric: np.sum([image[key][metric] for image in per_image], axis=0) for metric in ("detection", "pairing", "match")}
+        configs.append({
+            **dict(zip(("threshold", "match_threshold", "max_pairing_distance", "size_ratio"), key)),
+            **{metric: precision_recall(*(int(v) for v in totals[metric])) for metric in totals},
+            "latency_seconds": float(np.mean([image[key]["seconds"] for image in per_image]))
+        })
+    
+    configs.sort(key=lambda config: (config["match"]["f1"], config["pairing"]["f1"], config["detection"]["f1"]), reverse=True)
+    return configs
+
+
+def format_config(config):
+    
+    return (
+        f"det={config['threshold']:.2f} match={config['match_threshold']:.2f} "
+        f"pair={config['max_pairing_distance']:g} size={config['size_ratio']:.2f} | "
+        + " ".join(
+            f"{metric} P={config[metric]['precision']:.2f} R={config[metric]['recall']:.2f}"
+            for metric in ("detection", "pairing", "match")
+        )
+        + f" | {config['latency_seconds'] * 1000:.0f}ms"
+    )
+
+
+def main():
+    
+    parser = argparse.ArgumentParser(description="モデル出力をキャッシュして閾値を一括評価")
+    parser.add_argument("--labels", default=None, help="正解つき画像セットのJSON")
+    parser.add_argument("--synthetic", type=int, default=0, help="合成の棚画像N枚で評価")
+    parser.add_argument("--mode", choices=["stub", "real", "auto"], default="auto")
+    parser.add_argument("--text-prompt", default=TEXT_PROMPT)
+    parser.add_argument("--cache-dir", default="output/sweep_cache")
+    parser.add_argument("--thresholds", default="0.12,0.15,0.18,0.21,0.25")
+    parser.add_argument("--match-thresholds", default="0.6,0.65,0.7,0.75,0.8")
+    parser.add_argument("--pairing-distances", default="200,300,400")
+    parser.add_argument("--size-ratios", default="0.6,0.8,1.0")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="output/threshold_sweep.json")
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=os.environ.get("DETECT_LOG_LEVEL", "WARNING"), format="%(message)s")
+    
+    if not args.labels and not args.synthetic:
+        parser.error("--labels または --synthetic を指定してください")
+    
+    mode = args.mode
+    if mode == "auto":
+        mode = "real" if models_available() else "stub"
+    if mode == "real" and not models_available():
+        parser.error(f"モデルが見つかりません: {', '.join(MODEL_DIRS)}")
+    
+    grid = {
+        "threshold": parse_values(args.thresholds),
+        "match_threshold": parse_values(args.match_thresholds),
+        "max_pairing_distance": parse_values(args.pairing_distances),
+        "size_ratio": parse_values(args.size_ratios)
+    }
+    for name, value in DEFAULT_CONFIG.items():
+        if value not in grid[name]:
+            grid[name] = sorted(grid[name] + [value])
+    
+    labels_path = args.labels
+    if labels_path is None:
+        labels_path = write_synthetic_labels(os.path.join(args.cache_dir, "synthetic"), args.synthetic, args.seed)
+    labels = load_labels(labels_path)
+    
+    detector = build_detector(mode, labels["images"][0])
+    object_detector = detector.object_detector
+    siglip_classifier = detector.siglip_classifier
+    
+    reference_embeddings = {}
+    per_image = []
+    for entry in labels["images"]:
+        if mode == "stub":
+            # スタブは画像ごとの正解配置から検出結果を作る
+            with Image.open(entry["image_path"]) as image:
+                object_detector.layout = {**entry, "image_size": list(image.size)}
+        
+        cache = build_cache(
+            entry, object_detector, siglip_classifier, detector.barcode_reader,
+            args.text_prompt, args.cache_dir, min(grid["threshold"])
+        )
+        
+        target = entry["target_name"]
+        if target not in reference_embeddings:
+            reference_embeddings[target] = siglip_classifier.encode_images([labels["products"][target]["image_path"]])[0]
+        
+        per_image.append(evaluate_image(cache, entry, reference_embeddings[target], grid))
+        print(f"評価済み: {entry['image_path']}")
+    
+    configs = aggregate(per_image)
+    default = next(
+        config for config in configs
+        if all(config[name] == value for name, value in DEFAULT_CONFIG.items())
+    )
+    
+    print(f"\n{len(configs)}通りの設定を評価 (画像: {len(per_image)}枚, モード: {mode})")
+    print(f"上位{args.top}件:")
+    for config in configs[:args.top]:
+        print(f"  {format_config(config)}")
+    print("現在の既定値:")
+    print(f"  {format_config(default)}")
+    
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({"mode": mode, "labels": labels_path, "configs": configs}, f, ensure_ascii=False, indent=2)
+        print(f"\n結果を保存: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import zlib
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+# EAN-13のモジュールパターン（左側L/G、右側R）
+EAN13_L = ["0001101", "0011001", "0010011", "0111101", "0100011",
+           "0110001", "0101111", "0111011", "0110111", "0001011"]
+EAN13_R = ["".join("1" if bit == "0" else "0" for bit in code) for code in EAN13_L]
+EAN13_G = [code[::-1] for code in EAN13_R]
+
+# 先頭桁ごとの左側6桁のパリティ
+EAN13_PARITY = ["LLLLLL", "LLGLGG", "LLGGLG", "LLGGGL", "LGLLGG",
+                "LGGLLG", "LGGGLL", "LGLGLG", "LGLGGL", "LGGLGL"]
+
+
+def ean13_check_digit(digits):
+    
+    # 先頭から奇数桁は重み1、偶数桁は重み3
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits[:12]))
+    return str((10 - total % 10) % 10)
+
+
+def ean13_modules(code):
+    
+    # 95モジュール分のバー（1=黒）
+    parity = EAN13_PARITY[int(code[0])]
+    left = "".join(
+        (EAN13_L if p == "L" else EAN13_G)[int(d)] for p, d in zip(parity, code[1:7])
+    )
+    right = "".join(EAN13_R[int(d)] for d in code[7:13])
+    return "101" + left + "01010" + right + "101"
+
+
+def render_ean13(code, module_width=None, bar_height=None):
+    
+    if module_width is None:
+        module_width = 3
+    if bar_height is None:
+        bar_height = 80
+    
+    modules = ean13_modules(code)
+    quiet_zone = 11 * module_width
+    font = ImageFont.load_default()
+    text_height = 16
+    
+    image = Image.new("RGB", (len(modules) * module_width + quiet_zone * 2, bar_height + text_height + 8), "white")
+    draw = ImageDraw.Draw(image)
+    for i, bit in enumerate(modules):
+        if bit == "1":
+            x = quiet_zone + i * module_width
+            draw.rectangle([x, 4, x + module_width - 1, 4 + bar_height], fill="black")
+    
+    # バーの下に数字を表示（OCRフォールバックの対象）
+    draw.text((quiet_zone, bar_height + 6), code, fill="black", font=font)
+    return image
+
+
+def make_catalog(product_count, seed=None):
+    
+    if seed is None:
+        seed = 0
+    
+    rng = np.random.default_rng(seed)
+    catalog = []
+    for i in range(product_count):
+        # 日本のJANコード（49始まり）
+        body = "49" + "".join(str(d) for d in rng.integers(0, 10, size=10))
+        catalog.append({
+            "name": f"product-{i + 1:02d}",
+            "barcode": body + ean13_check_digit(body)
+        })
+    return catalog
+
+
+def render_product_face(name, size):
+    
+    # 商品名から決まる配色・模様のパッケージ
+    rng = np.random.default_rng(zlib.crc32(name.encode("utf-8")))
+    width, height = size
+    colors = [tuple(int(c) for c in rng.integers(0, 256, size=3)) for _ in range(3)]
+    
+    image = Image.new("RGB", (width, height), colors[0])
+    draw = ImageDraw.Draw(image)
+    
+    band = rng.uniform(0.2, 0.6)
+    if rng.random() < 0.5:
+        draw.rectangle([0, int(height * band), width, int(height * (band + 0.25))], fill=colors[1])
+    else:
+        draw.rectangle([int(width * band * 0.5), 0, int(width * (band * 0.5 + 0.3)), height], fill=colors[1])
+    
+    cx, cy = rng.uniform(0.3, 0.7) * width, rng.uniform(0.2, 0.8) * height
+    radius = min(width, height) * rng.uniform(0.15, 0.3)
+    draw.ellipse([cx - radius, cy - radius, cx + radius, cy + radius], fill=colors[2])
+    draw.text((width * 0.1, height * 0.05), name, fill="white", font=ImageFont.load_default())
+    return image
+
+
+def render_tag(barcode, size, module_width):
+    
+    width, height = size
+    tag = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(tag)
+    draw.rectangle([0, 0, width - 1, height - 1], outline=(180, 180, 180), width=2)
+    
+    bars = render_ean13(barcode, module_width=module_width, bar_height=int(height * 0.55))
+    tag.paste(bars, ((width - bars.width) // 2, height - bars.height - 4))
+    draw.text((8, 6), "PRICE 1,280", fill="black", font=ImageFont.load_default())
+    return tag
+
+
+def make_shelf(image_size=None, rows=None, columns=None, catalog=None, target_name=None, seed=None):
+    
+    if image_size is None:
+        image_size = (4000, 3000)
+    if rows is None:
+        rows = 4
+    if columns is None:
+        columns = 8
+    if catalog is None:
+        catalog = make_catalog(6)
+    if target_name is None:
+        target_name = catalog[0]["name"]
+    if seed is None:
+        seed = 0
+    
+    rng = np.random.default_rng(seed)
+    width, height = image_size
+    image = Image.new("RGB", image_size, (235, 232, 225))
+    draw = ImageDraw.Draw(image)
+    
+    row_height = height / rows
+    slot_width = width / columns
+    tag_width = int(slot_width * 0.8)
+    tag_height = int(row_height * 0.22)
+    module_width = max(1, int(tag_width * 0.9) // 117)
+    
+    # 各棚に商品を並べる（検索対象の商品が必ず含まれるようにする）
+    names = [item["name"] for item in catalog]
+    placement = rng.choice(len(catalog), size=rows * columns)
+    placement[rng.choice(rows * columns, size=max(1, rows * columns // 8), replace=False)] = names.index(target_name)
+    barcodes = {item["name"]: item["barcode"] for item in catalog}
+    
+    products = []
+    tags = []
+    for row in range(rows):
+        top = row * row_height
+        shelf_y = int(top + row_height - tag_height - row_height * 0.04)
+        
+        # 棚板
+        draw.rectangle([0, shelf_y, width, int(top + row_height)], fill=(120, 110, 100))
+        
+        for column in range(columns):
+            name = names[placement[row * columns + column]]
+            left = column * slot_width
+            
+            product_width = int(slot_width * rng.uniform(0.55, 0.8))
+            product_height = int(row_height * rng.uniform(0.45, 0.65))
+            x1 = int(left + (slot_width - product_width) / 2)
+            y1 = shelf_y - product_height - 4
+            image.paste(render_product_face(name, (product_width, product_height)), (x1, y1))
+            products.append({
+                "box": [x1, y1, x1 + product_width, y1 + product_height],
+                "name": name,
+                "barcode": barcodes[name]
+            })
+            
+            # 値札は商品の真下の棚板に貼る
+            tx1 = int(left + (slot_width - tag_width) / 2)
+            ty1 = shelf_y + int(row_height * 0.02)
+            image.paste(render_tag(barcodes[name], (tag_width, tag_height), module_width), (tx1, ty1))
+            tags.append({
+                "box": [tx1, ty1, tx1 + tag_width, ty1 + tag_height],
+                "barcode": barcodes[name]
+            })
+    
+    layout = {
+        "image_size": list(image_size),
+        "target_name": target_name,
+        "catalog": catalog,
+        "products": products,
+        "tags": tags,
+        # 商品と値札の正解ペア（[商品の番号, 値札の番号]）
+        "pairs": [[i, i] for i in range(len(products))]
+    }
+    return image, layout
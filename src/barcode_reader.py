@@ -1,27 +1,45 @@
 import cv2
+import numpy as np
 from pyzbar import pyzbar
 import easyocr
 import re
+import logging
+from perf import recorder
+
+logger = logging.getLogger(__name__)
 
 
 class BarcodeReader:
     
-    def __init__(self, product_registry):
+    def __init__(self, product_registry, ocr_reader=None):
         self.product_registry = product_registry
+        
+        # OCRリーダーを指定した場合はそのまま使用（ベンチマーク用のスタブなど）
+        if ocr_reader is not None:
+            self.ocr_reader = ocr_reader
+            return
+        
         # EasyOCR reader の初期化（数字のみ）
-        print("OCRリーダーを読み込み中...")
-        self.ocr_reader = easyocr.Reader(['en'])
-        print("OCRリーダーの読み込みが完了")
+        logger.info("OCRリーダーを読み込み中...")
+        with recorder.stage("model_load.ocr"):
+            self.ocr_reader = easyocr.Reader(['en'])
+        logger.info("OCRリーダーの読み込みが完了")
     
     def detect_barcode_from_image(self, image_path):
         
-        image = cv2.imread(image_path)
+        # パスとRGB画像（PIL画像・切り出し）のどちらも受け付ける（OpenCVと同じBGR配列に変換）
+        if isinstance(image_path, str):
+            image = cv2.imread(image_path)
+        else:
+            image = cv2.cvtColor(np.asarray(image_path), cv2.COLOR_RGB2BGR)
         
         if image is None:
             return []
         
         # 通常の画像でバーコード検出
-        barcodes = pyzbar.decode(image)
+        with recorder.stage("barcode.decode"):
+            barcodes = pyzbar.decode(image)
+        recorder.count("barcode_decodes")
         
         results = []
         for barcode in barcodes:
@@ -29,14 +47,16 @@ class BarcodeReader:
             if barcode.type == 'EAN13':
                 barcode_data = barcode.data.decode('utf-8')
                 results.append(barcode_data)
-                print(f"    JAN-13検出: {barcode_data}")
+                logger.debug("    JAN-13検出: %s", barcode_data)
             else:
-                print(f"    スキップ ({barcode.type}): {barcode.data.decode('utf-8')}")
+                logger.debug("    スキップ (%s): %s", barcode.type, barcode.data.decode('utf-8'))
         
         # バーコードが見つからない場合はOCRで数字を読み取る
         if len(results) == 0:
-            print(f"    バーコード検出失敗、OCRで数字を読み取り中...")
-            ocr_result = self._read_numbers_with_ocr(image)
+            logger.debug("    バーコード検出失敗、OCRで数字を読み取り中...")
+            recorder.count("ocr_fallbacks")
+            with recorder.stage("barcode.ocr"):
+                ocr_result = self._read_numbers_with_ocr(image)
             if ocr_result:
                 results.append(ocr_result)
         
@@ -54,44 +74,55 @@ class BarcodeReader:
             
             if len(numbers) == 13:
                 # ちょうど13桁の数字のかたまりを見つけた
-                print(f"      OCR検出: '{text}' → JANコード: '{numbers}' (信頼度: {prob:.2f})")
+                logger.debug("      OCR検出: '%s' → JANコード: '%s' (信頼度: %.2f)", text, numbers, prob)
                 return numbers
             elif numbers:
-                print(f"      OCR検出: '{text}' → 数字: '{numbers}' ({len(numbers)}桁, スキップ)")
+                logger.debug("      OCR検出: '%s' → 数字: '%s' (%d桁, スキップ)", text, numbers, len(numbers))
         
         # 13桁の数字のかたまりが見つからなかった
-        print(f"      13桁の数字のかたまりが検出できませんでした")
+        logger.debug("      13桁の数字のかたまりが検出できませんでした")
         return None
     
-    def verify_product_by_barcode(self, tag_image_path, product_name):
+    def read_barcode(self, tag_image_path):
         
         # タグからJANコードを検出
         barcodes = self.detect_barcode_from_image(tag_image_path)
         
         if not barcodes:
-            print(f"    JANコードが検出できませんでした")
-            return False, None
+            logger.info("    JANコードが検出できませんでした")
+            return None
         
         detected_barcode = barcodes[0]  # 最初のJANコードを使用
-        print(f"    検出されたJANコード: {detected_barcode}")
+        logger.info("    検出されたJANコード: %s", detected_barcode)
+        return detected_barcode
+    
+    def verify_product_by_barcode(self, tag_image_path, product_name):
+        
+        detected_barcode = self.read_barcode(tag_image_path)
+        if detected_barcode is None:
+            return False, None
+        
+        return self.verify_barcode(detected_barcode, product_name)
+    
+    def verify_barcode(self, detected_barcode, product_name):
         
         # 商品辞書から期待されるJANコードを取得
         if product_name not in self.product_registry:
-            print(f"    警告: '{product_name}'は登録されていません")
+            logger.warning("    警告: '%s'は登録されていません", product_name)
             return False, detected_barcode
         
         expected_barcode = self.product_registry[product_name].get('barcode')
         
         if not expected_barcode:
-            print(f"    警告: '{product_name}'にJANコードが登録されていません")
+            logger.warning("    警告: '%s'にJANコードが登録されていません", product_name)
             return None, detected_barcode
         
         # JANコードを比較
         is_match = detected_barcode == expected_barcode
         
         if is_match:
-            print(f"    ✓ JANコード一致: {detected_barcode}")
+            logger.info("    ✓ JANコード一致: %s", detected_barcode)
         else:
-            print(f"    ✗ JANコード不一致: 期待値={expected_barcode}, 検出値={detected_barcode}")
+            logger.info("    ✗ JANコード不一致: 期待値=%s, 検出値=%s", expected_barcode, detected_barcode)
         
         return is_match, detected_barcode
@@ -0,0 +1,70 @@
+import numpy as np
+from detection_set import UNCLASSIFIED
+
+
+def clip_boxes(boxes, image_size):
+    
+    # 画像の範囲に収める
+    width, height = image_size
+    return np.clip(boxes, 0, [width, height, width, height]).astype(np.float32)
+
+
+def box_sizes(boxes):
+    return boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]
+
+
+def nms(boxes, scores, iou_threshold, class_ids=None):
+    
+    # スコアの高い順に、重なりの大きいボックスを除去（残す行を昇順で返す）
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1) * (y2 - y1)
+    if class_ids is None:
+        order = np.argsort(-scores, kind="stable")
+    else:
+        # ラベル付きのボックスを先に処理し、スコアによらず重なる未分類のボックスを除去できるようにする
+        order = np.lexsort((-scores, class_ids == UNCLASSIFIED))
+    
+    keep = []
+    while len(order) > 0:
+        best = order[0]
+        keep.append(best)
+        rest = order[1:]
+        
+        width = np.clip(np.minimum(x2[best], x2[rest]) - np.maximum(x1[best], x1[rest]), 0, None)
+        height = np.clip(np.minimum(y2[best], y2[rest]) - np.maximum(y1[best], y1[rest]), 0, None)
+        intersection = width * height
+        iou = intersection / np.maximum(areas[best] + areas[rest] - intersection, 1e-6)
+        suppressed = iou > iou_threshold
+        
+        if class_ids is not None:
+            # 異なるクラス同士は除去しない。未分類はラベル付きのボックスに除去されうるが、
+            # 未分類がラベル付き（値札など）を除去することはない
+            suppressed &= (class_ids[rest] == class_ids[best]) | (class_ids[rest] == UNCLASSIFIED)
+        order = rest[~suppressed]
+    
+    return np.sort(np.array(keep, dtype=np.int64))
+
+
+def class_aware_nms(boxes, scores, class_ids, iou_threshold):
+    
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    
+    # 同じクラス同士に加え、ラベルのない検出（SigLIPで商品と判定されると重複になる）は重なるラベル付きの検出に除去される
+    return nms(boxes, scores, iou_threshold, class_ids=class_ids)
+
+
+def prefilter_boxes(boxes, scores, class_ids, image_size, max_width_ratio, max_height_ratio, min_box_size, iou_threshold):
+    
+    boxes = clip_boxes(boxes, image_size)
+    widths, heights = box_sizes(boxes)
+    large_enough = (widths >= min_box_size) & (heights >= min_box_size)
+    too_large = (widths / image_size[0] > max_width_ratio) | (heights / image_size[1] > max_height_ratio)
+    
+    # 大きすぎるものは除外として残し、それ以外は同じクラスとの重複と、ラベル付きと重なる未分類を除去
+    candidates = np.flatnonzero(large_enough & ~too_large)
+    survivors = candidates[class_aware_nms(boxes[candidates], scores[candidates], class_ids[candidates], iou_threshold)]
+    keep = np.sort(np.concatenate([survivors, np.flatnonzero(large_enough & too_large)]))
+    
+    # 補正後の全ボックス、残す行、各ボックスの除外フラグ、最小サイズ以上か
+    return boxes, keep, too_large, large_enough
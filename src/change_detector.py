@@ -0,0 +1,295 @@
+import os
+import json
+import logging
+import cv2
+import numpy as np
+from perf import recorder
+
+logger = logging.getLogger(__name__)
+
+
+class ShelfChangeDetector:
+    
+    def __init__(self, max_features=None, min_matches=None, diff_threshold=None,
+                 min_region_area=None, region_padding=None):
+        if max_features is None:
+            max_features = 5000
+        if min_matches is None:
+            min_matches = 30
+        if diff_threshold is None:
+            diff_threshold = 40
+        if min_region_area is None:
+            min_region_area = 1500
+        if region_padding is None:
+            region_padding = 64
+        
+        self.min_matches = min_matches
+        self.diff_threshold = diff_threshold
+        self.min_region_area = min_region_area
+        self.region_padding = region_padding
+        
+        # 特徴点検出器とマッチャー（ORBはバイナリ特徴量なのでハミング距離を使用）
+        self.orb = cv2.ORB_create(nfeatures=max_features)
+        self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True)
+    
+    def _to_gray(self, image):
+        
+        # グレースケール画像（保存した位置合わせ用画像）はそのまま使う
+        array = np.asarray(image)
+        if array.ndim == 2:
+            return array
+        return cv2.cvtColor(array, cv2.COLOR_RGB2GRAY)
+    
+    def align(self, previous_image, current_image):
+        
+        previous_gray = self._to_gray(previous_image)
+        current_gray = self._to_gray(current_image)
+        
+        # 特徴点の検出
+        previous_keypoints, previous_descriptors = self.orb.detectAndCompute(previous_gray, None)
+        current_keypoints, current_descriptors = self.orb.detectAndCompute(current_gray, None)
+        
+        if previous_descriptors is None or current_descriptors is None:
+            logger.warning("  位置合わせ失敗: 特徴点が検出できませんでした")
+            return None
+        
+        matches = self.matcher.match(previous_descriptors, current_descriptors)
+        if len(matches) < self.min_matches:
+            logger.warning("  位置合わせ失敗: 対応点が不足 (%d個)", len(matches))
+            return None
+        
+        # 前回画像 → 今回画像 のホモグラフィを推定
+        src_points = np.float32([previous_keypoints[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
+        dst_points = np.float32([current_keypoints[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
+        homography, inlier_mask = cv2.findHomography(src_points, dst_points, cv2.RANSAC, 5.0)
+        
+        if homography is None or int(inlier_mask.sum()) < self.min_matches:
+            logger.warning("  位置合わせ失敗: ホモグラフィを推定できませんでした")
+            return None
+        
+        logger.info("  位置合わせ完了 (対応点: %d個, インライア: %d個)", len(matches), int(inlier_mask.sum()))
+        return homography
+    
+    def find_changed_regions(self, previous_image, current_image, homography):
+        
+        width, height = current_image.size
+        previous_array = np.asarray(previous_image)
+        
+        # 前回画像を今回画像の座標系に変換
+        warped = cv2.warpPerspective(previous_array, homography, (width, height))
+        coverage = cv2.warpPerspective(
+            np.full(previous_array.shape[:2], 255, dtype=np.uint8), homography, (width, height)
+        )
+        # 前回画像に写っていない画素（画像端）と、補間の影響を受ける境界付近
+        uncovered = coverage == 0
+        coverage = cv2.erode(coverage, np.ones((5, 5), np.uint8))
+        
+        # 照明やノイズの影響を抑えるためにぼかしてから差分を取る
+        previous_gray = cv2.GaussianBlur(self._to_gray(warped), (5, 5), 0)
+        current_gray = cv2.GaussianBlur(self._to_gray(current_image), (5, 5), 0)
+        diff = cv2.absdiff(previous_gray, current_gray)
+        
+        mask = np.where(diff > self.diff_threshold, 255, 0).astype(np.uint8)
+        mask[coverage == 0] = 0
+        
+        # 前回画像に写っていない範囲は変化ありとみなし、差分と同じノイズ除去・面積判定を通す
+        # （手持ち撮影の数ピクセルのずれで生じる細い帯は除去される）
+        mask[uncovered] = 255
+        
+        # 小さなノイズを除去し、近接する変化をつなげる
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, np.ones((5, 5), np.uint8))
+        mask = cv2.dilate(mask, np.ones((15, 15), np.uint8))
+        
+        count, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+        
+        regions = []
+        for i in range(1, count):
+            x, y, w, h, area = stats[i]
+            if area < self.min_region_area:
+                continue
+            regions.append([int(x), int(y), int(x + w), int(y + h)])
+        
+        return self._merge_regions(regions)
+    
+    def _merge_regions(self, regions):
+        
+        # 重なる領域を結合（結合すると無駄に広くなる組み合わせは結合しない）
+        merged = [list(region) for region in regions]
+        changed = True
+        while changed:
+            changed = False
+            result = []
+            for region in merged:
+                for other in result:
+                    union_area = (
+                        (max(other[2], region[2]) - min(other[0], region[0])) *
+                        (max(other[3], region[3]) - min(other[1], region[1]))
+                    )
+                    separate_area = (
+                        (region[2] - region[0]) * (region[3] - region[1]) +
+                        (other[2] - other[0]) * (other[3] - other[1])
+                    )
+                    if (region[0] <= other[2] and other[0] <= region[2] and
+                            region[1] <= other[3] and other[1] <= region[3] and
+                            union_area <= separate_area):
+                        other[0] = min(other[0], region[0])
+                        other[1] = min(other[1], region[1])
+                        other[2] = max(other[2], region[2])
+                        other[3] = max(other[3], region[3])
+                        changed = True
+                        break
+                else:
+                    result.append(region)
+            merged = result
+        
+        return merged
+    
+    def expand_region(self, region, image_size):
+        
+        # 領域の境界で切れた物体も検出できるように余白を付ける
+        width, height = image_size
+        x1, y1, x2, y2 = region
+        return [
+            max(0, x1 - self.region_padding),
+            max(0, y1 - self.region_padding),
+            min(width, x2 + self.region_padding),
+            min(height, y2 + self.region_padding)
+        ]
+    
+    def transform_boxes(self, boxes, homography):
+        
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        if len(boxes) == 0:
+            return boxes
+        
+        # 4隅を変換し、外接矩形を新しいボックスとする
+        corners = np.stack([
+            boxes[:, [0, 1]], boxes[:, [2, 1]], boxes[:, [2, 3]], boxes[:, [0, 3]]
+        ], axis=1).reshape(-1, 1, 2)
+        warped = cv2.perspectiveTransform(corners, homography).reshape(-1, 4, 2)
+        
+        return np.concatenate([warped.min(axis=1), warped.max(axis=1)], axis=1)
+    
+    def _overlaps_regions(self, boxes, regions):
+        
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        if not regions:
+            return np.zeros(len(boxes), dtype=bool)
+        
+        regions = np.asarray(regions, dtype=np.float32)
+        overlap = (
+            (boxes[:, None, 0] < regions[None, :, 2]) & (regions[None, :, 0] < boxes[:, None, 2]) &
+            (boxes[:, None, 1] < regions[None, :, 3]) & (regions[None, :, 1] < boxes[:, None, 3])
+        )
+        return overlap.any(axis=1)
+    
+    def carry_over_objects(self, previous_state, homography, regions, image_size):
+        
+        objects = previous_state['objects']
+        if not objects:
+            return []
+        
+        width, height = image_size
+        boxes = self.transform_boxes([obj['box'] for obj in objects], homography)
+        boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, width)
+        boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, height)
+        
+        # 変化領域にかかる物体と画像外に出た物体は再検出の対象
+        changed = self._overlaps_regions(boxes, regions)
+        visible = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+        
+        carried = []
+        for obj, box, is_changed, is_visible in zip(objects, boxes, changed, visible):
+            if is_changed or not is_visible:
+                continue
+            carried.append({**obj, 'box': box})
+        
+        return carried
+    
+    def merge_detections(self, image, carried_objects, region_results, regions):
+        
+        # 変化領域にかからない検出は領域の余白部分で検出された重複なので除外
+        keep = self._overlaps_regions(region_results["boxes"], regions)
+        new_boxes = np.asarray(region_results["boxes"], dtype=np.float32).reshape(-1, 4)[keep]
+        new_scores = np.asarray(region_results["scores"], dtype=np.float32)[keep]
+        new_labels = [label for label, k in zip(region_results["labels"], keep) if k]
+        
+        carried_boxes = np.asarray([obj['box'] for obj in carried_objects], dtype=np.float32).reshape(-1, 4)
+        carried_scores = np.asarray([obj['score'] for obj in carried_objects], dtype=np.float32)
+        carried_labels = [obj['label'] for obj in carried_objects]
+        
+        recorder.count("objects_carried", len(carried_objects))
+        logger.info("  引き継ぎ: %d個, 再検出: %d個", len(carried_objects), len(new_labels))
+        
+        return {
+            "image": image,
+            "boxes": np.concatenate([carried_boxes, new_boxes]),
+            "scores": np.concatenate([carried_scores, new_scores]),
+            "labels": carried_labels + new_labels,
+            "carried": list(carried_objects) + [None] * len(new_labels)
+        }
+    
+    def build_state(self, image_path, image_size, session, target_product_name=None):
+        
+        detections = session.detections
+        embedding_rows = np.full(len(detections), -1, dtype=np.int32)
+        embedding_rows[session.product_rows] = np.arange(len(session.product_rows))
+        
+        objects = []
+        for row in range(len(detections)):
+            obj = {
+                'box': [float(v) for v in detections.boxes[row]],
+                'score': float(detections.scores[row]),
+                'label': detections.label(row),
+                'class': detections.class_name(row),
+                'embedding_row': int(embedding_rows[row]) if embedding_rows[row] >= 0 else None
+            }
+            # 読み取りを試みたタグのみJANコードを保存（失敗はnull）
+            if row in session.tag_barcodes:
+                obj['barcode_data'] = session.tag_barcodes[row]
+            objects.append(obj)
+        
+        state = {
+            'image_path': image_path,
+            'image_size': list(image_size),
+            'target_product_name': target_product_name,
+            'objects': objects
+        }
+        return state, session.product_embeddings
+    
+    def _embeddings_path(self, state_path):
+        return os.path.splitext(state_path)[0] + "_embeddings.npy"
+    
+    def _alignment_path(self, state_path):
+        return os.path.splitext(state_path)[0] + "_alignment.png"
+    
+    def save_state(self, state, state_path, embeddings=None, alignment_image=None):
+        
+        os.makedirs(os.path.dirname(state_path) or ".", exist_ok=True)
+        with open(state_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        if embeddings is not None:
+            np.save(self._embeddings_path(state_path), embeddings)
+        
+        # 元画像のパスは上書き・移動されることがあるため、位置合わせに使う画素を状態と一緒に保存
+        if alignment_image is not None:
+            cv2.imwrite(self._alignment_path(state_path), self._to_gray(alignment_image))
+        logger.info("棚の状態を保存: %s", state_path)
+    
+    def load_state(self, state_path):
+        
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        
+        # 商品の埋め込みを各物体に対応付ける
+        embeddings_path = self._embeddings_path(state_path)
+        embeddings = np.load(embeddings_path) if os.path.exists(embeddings_path) else None
+        for obj in state['objects']:
+            row = obj.get('embedding_row')
+            obj['embedding'] = embeddings[row] if embeddings is not None and row is not None else None
+        
+        # 前回画像の位置合わせ用グレースケール画像（ない場合はNone）
+        alignment_path = self._alignment_path(state_path)
+        state['alignment_image'] = cv2.imread(alignment_path, cv2.IMREAD_GRAYSCALE) if os.path.exists(alignment_path) else None
+        
+        return state
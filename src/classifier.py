@@ -1,22 +1,35 @@
 import torch
+import logging
+import numpy as np
 from PIL import Image
 from transformers import AutoProcessor, AutoModel
+from perf import recorder
+from profiling import Profiler
+
+logger = logging.getLogger(__name__)
 
 class SigLIPClassifier:
     
     def __init__(self):
-
+        
         self.device = "mps"
         self.model_id = "models/siglip-base-patch16-224"
         
+        # 商品マッチングの類似度閾値
+        self.match_threshold = 0.7
+        
+        # プロファイラ（既定は無効）
+        self.profiler = Profiler()
         
-        print("SigLIPモデルを読み込み中...")
+        
+        logger.info("SigLIPモデルを読み込み中...")
         
         # SigLIPの読み込み
-        self.processor = AutoProcessor.from_pretrained(self.model_id, use_fast=True)
-        self.model = AutoModel.from_pretrained(self.model_id).to(self.device)
+        with recorder.stage("model_load.siglip"):
+            self.processor = AutoProcessor.from_pretrained(self.model_id, use_fast=True)
+            self.model = AutoModel.from_pretrained(self.model_id).to(self.device)
         
-        print("SigLIPモデルの読み込みが完了\n")
+        logger.info("SigLIPモデルの読み込みが完了\n")
         
         # 事前にテキスト特徴量を計算
         self.precompute_text_features()
@@ -40,20 +53,53 @@ class SigLIPClassifier:
             # 正規化
             self.text_features = outputs / outputs.norm(dim=-1, keepdim=True)
     
+    def _load_image(self, image):
+        
+        # パスとPIL画像のどちらも受け付ける
+        if isinstance(image, str):
+            return Image.open(image).convert("RGB")
+        return image.convert("RGB")
+    
+    def encode_images(self, images, batch_size=None):
+        
+        if batch_size is None:
+            batch_size = 32
+        
+        # 全バッチをまとめて1つのトレースとしてプロファイル
+        features = []
+        with self.profiler.torch_section("siglip_encode"):
+            for start in range(0, len(images), batch_size):
+                batch = [self._load_image(image) for image in images[start:start + batch_size]]
+                inputs = self.processor(images=batch, return_tensors="pt")
+                inputs = {k: v.to(self.device) for k, v in inputs.items()}
+                
+                # バッチ単位で画像特徴量を抽出し正規化
+                with recorder.stage("siglip.forward"), torch.no_grad():
+                    outputs = self.model.get_image_features(**inputs)
+                    outputs = outputs / outputs.norm(dim=-1, keepdim=True)
+                features.append(outputs.cpu().numpy().astype(np.float32))
+                recorder.count("siglip_images", len(batch))
+        
+        if not features:
+            return np.zeros((0, self.model.config.vision_config.hidden_size), dtype=np.float32)
+        return np.concatenate(features)
+    
     def classify_image(self, image_path, return_probs=False):
         
         # 画像の読み込みと前処理
-        image = Image.open(image_path).convert("RGB")
+        image = self._load_image(image_path)
         inputs = self.processor(images=image, return_tensors="pt")
         
         # デバイスに移動
         inputs = {k: v.to(self.device) for k, v in inputs.items()}
         
         # 画像特徴量の抽出
-        with torch.no_grad():
-
+        recorder.count("siglip_images")
+        # プロファイルは呼び出し側で分類ステージ全体をまとめて取得する
+        with recorder.stage("siglip.forward"), torch.no_grad():
+            
             outputs = self.model.get_image_features(**inputs)
-
+            
             # 正規化
             image_features = outputs / outputs.norm(dim=-1, keepdim=True)
             
@@ -62,7 +108,7 @@ class SigLIPClassifier:
             
             logit_scale = self.model.logit_scale.exp()
             logit_bias = self.model.logit_bias
-
+            
             logits = (similarities * logit_scale) + logit_bias
             
             # 各クラスへの所属確率
@@ -105,7 +151,7 @@ class SigLIPClassifier:
         inputs2 = {k: v.to(self.device) for k, v in inputs2.items()}
         
         # 画像特徴量を抽出
-        with torch.no_grad():
+        with self.profiler.torch_section("siglip"), torch.no_grad():
             outputs1 = self.model.get_image_features(**inputs1)
             outputs2 = self.model.get_image_features(**inputs2)
             
@@ -117,8 +163,7 @@ class SigLIPClassifier:
             similarity = (features1 @ features2.T).squeeze().item()
         
         # 閾値で判定
-        threshold = 0.7
-        is_match = similarity >= threshold
+        is_match = similarity >= self.match_threshold
         
         if return_similarity:
             return is_match, similarity
@@ -0,0 +1,288 @@
+import os
+import numpy as np
+from PIL import Image
+from perf import recorder
+
+
+# class_idsの値とクラス名の対応（-1は未分類）
+CLASS_NAMES = ("product", "tag")
+PRODUCT = 0
+TAG = 1
+UNCLASSIFIED = -1
+
+
+def class_id_from_label(label):
+    
+    # Grounding DINOのラベルから分類を決定
+    label = label.lower()
+    if "product" in label:
+        return PRODUCT
+    if "tag" in label:
+        return TAG
+    return UNCLASSIFIED
+
+
+class ImageBuffer:
+    
+    def __init__(self, image):
+        # 1枚のデコード済み画像をNumPy配列として1つだけ保持し、全ての切り出しで共有する
+        # （PIL画像と配列を両方保持すると画像2枚分のメモリを使うため、PIL画像は参照しない）
+        self.array = np.asarray(image)
+    
+    @property
+    def released(self):
+        return self.array is None
+    
+    @property
+    def size(self):
+        return (self.array.shape[1], self.array.shape[0])
+    
+    def crop(self, box):
+        
+        if self.released:
+            raise RuntimeError("元画像は解放済みのため切り出せません（DetectionSet.cropは保存済みの切り出し画像を読み込みます）")
+        
+        # コピーせずにビューを返す
+        x1, y1, x2, y2 = box
+        return self.array[y1:y2, x1:x2]
+    
+    def release(self):
+        self.array = None
+
+
+class LazyCrop:
+    
+    def __init__(self, buffer, box):
+        
+        # 画像の範囲に収めて、sizeと実際の画素の範囲を一致させる
+        self.buffer = buffer
+        width, height = buffer.size
+        x1, y1, x2, y2 = (int(v) for v in box)
+        x1 = min(max(x1, 0), width)
+        y1 = min(max(y1, 0), height)
+        self.box = (x1, y1, min(max(x2, x1), width), min(max(y2, y1), height))
+    
+    @property
+    def size(self):
+        x1, y1, x2, y2 = self.box
+        return (x2 - x1, y2 - y1)
+    
+    def convert(self, mode=None):
+        # 画素が必要になった時点でPIL画像として切り出す（コピーは切り出した範囲のみ）
+        image = Image.fromarray(self.buffer.crop(self.box))
+        return image.convert(mode) if mode and mode != image.mode else image
+    
+    def save(self, filepath):
+        self.convert().save(filepath)
+    
+    def __array__(self, dtype=None, copy=None):
+        
+        # 共有バッファのビューを返す（copy=Trueまたは型変換が必要な場合のみコピー）
+        array = self.buffer.crop(self.box)
+        if dtype is not None and array.dtype != np.dtype(dtype):
+            if copy is False:
+                raise ValueError("型変換が必要なため、コピーせずに配列を返せません")
+            return array.astype(dtype)
+        return array.copy() if copy else array
+
+
+class FullResolutionSource:
+    
+    def __init__(self, image_path, detection_size):
+        self.image_path = os.path.abspath(image_path)
+        self.detection_size = tuple(detection_size)
+        
+        # 元解像度の切り出し（行 → PIL画像）
+        self.crops = {}
+        
+        # ヘッダのみ読み込んで元画像のサイズを取得
+        with Image.open(image_path) as image:
+            self.size = image.size
+        self.scale = (self.size[0] / self.detection_size[0], self.size[1] / self.detection_size[1])
+        
+        # 保存したセッションの再開時に、元画像が差し替えられていないか確認するための情報
+        stat = os.stat(image_path)
+        self.file_size = stat.st_size
+        self.mtime = stat.st_mtime
+    
+    def crop_rows(self, rows, boxes):
+        
+        # 元解像度の画像は1回だけデコードし、必要な切り出しをまとめて作成したらすぐに手放す
+        pending = [int(row) for row in rows if int(row) not in self.crops]
+        if not pending:
+            return
+        
+        with recorder.stage("decode.full_resolution"):
+            with Image.open(self.image_path) as source:
+                image = source.convert("RGB")
+        recorder.count("full_resolution_decodes")
+        
+        sx, sy = self.scale
+        for row in pending:
+            x1, y1, x2, y2 = boxes[row]
+            self.crops[row] = image.crop((int(x1 * sx), int(y1 * sy), int(x2 * sx), int(y2 * sy)))
+    
+    def to_dict(self):
+        return {
+            "image_path": self.image_path,
+            "detection_size": list(self.detection_size),
+            "file_size": self.file_size,
+            "mtime": self.mtime
+        }
+    
+    @classmethod
+    def from_dict(cls, data):
+        
+        # 元画像がない・保存後に変更された場合は使わない（None）
+        image_path = data["image_path"]
+        if not os.path.exists(image_path):
+            return None
+        stat = os.stat(image_path)
+        if stat.st_size != data["file_size"] or stat.st_mtime != data["mtime"]:
+            return None
+        return cls(image_path, data["detection_size"])
+
+
+class DetectionSet:
+    
+    def __init__(self, image, boxes, scores, labels, class_ids=None, filtered=None,
+                 original_indices=None, filepaths=None, carried=None, image_size=None,
+                 full_resolution=None):
+        
+        count = len(scores)
+        self.buffer = ImageBuffer(image) if image is not None else None
+        self.image_size = self.buffer.size if self.buffer is not None else image_size
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(count, 4)
+        self.scores = np.asarray(scores, dtype=np.float32)
+        
+        # ラベル文字列は種類が少ないので語彙とIDで保持
+        self.label_names = sorted(set(labels))
+        label_lookup = {name: i for i, name in enumerate(self.label_names)}
+        self.label_ids = np.fromiter((label_lookup[label] for label in labels), dtype=np.int16, count=count)
+        
+        if class_ids is None:
+            class_ids = [class_id_from_label(label) for label in labels]
+        self.class_ids = np.asarray(class_ids, dtype=np.int8)
+        self.filtered = np.zeros(count, dtype=bool) if filtered is None else np.asarray(filtered, dtype=bool)
+        self.original_indices = (
+            np.arange(count, dtype=np.int32) if original_indices is None
+            else np.asarray(original_indices, dtype=np.int32)
+        )
+        
+        # ペアリング結果（商品の行 → タグの行、未ペアは-1）
+        self.pair_index = np.full(count, -1, dtype=np.int32)
+        self.pair_distance = np.full(count, np.nan, dtype=np.float32)
+        
+        self.filepaths = filepaths
+        self.carried = carried
+        self.full_resolution = full_resolution
+    
+    def __len__(self):
+        return len(self.scores)
+    
+    @property
+    def indices(self):
+        # 表示・JSON出力用の1始まりのインデックス
+        return np.arange(1, len(self) + 1, dtype=np.int32)
+    
+    @property
+    def width_ratios(self):
+        return (self.boxes[:, 2] - self.boxes[:, 0]) / self.image_size[0]
+    
+    @property
+    def height_ratios(self):
+        return (self.boxes[:, 3] - self.boxes[:, 1]) / self.image_size[1]
+    
+    @property
+    def active(self):
+        return ~self.filtered
+    
+    def rows(self, class_id=None, include_filtered=False):
+        
+        mask = np.ones(len(self), dtype=bool) if include_filtered else self.active
+        if class_id is not None:
+            mask = mask & (self.class_ids == class_id)
+        return np.flatnonzero(mask)
+    
+    def label(self, row):
+        return self.label_names[self.label_ids[row]]
+    
+    def class_name(self, row):
+        class_id = self.class_ids[row]
+        return CLASS_NAMES[class_id] if class_id >= 0 else None
+    
+    def carried_object(self, row):
+        return self.carried[row] if self.carried is not None else None
+    
+    @property
+    def image(self):
+        # 共有バッファのRGB配列（解放済みの場合はNone）
+        return self.buffer.array if self.buffer is not None else None
+    
+    def crop(self, row, full_resolution=False):
+        
+        # 元解像度の画像が参照できる場合はそこから切り出す
+        # （最初の1回で全タグをまとめて切り出してキャッシュし、以降の検索ではデコードしない）
+        if full_resolution and self.full_resolution is not None:
+            row = int(row)
+            self.full_resolution.crop_rows(np.union1d(self.rows(TAG), [row]), self.boxes)
+            return self.full_resolution.crops[row]
+        
+        # 画像を解放済みの場合は保存済みの切り出し画像を読み込む
+        if self.buffer is None or self.buffer.released:
+            return Image.open(self.filepaths[row]).convert("RGB")
+        return LazyCrop(self.buffer, self.boxes[row])
+    
+    def release_image(self):
+        
+        # 切り出しが不要になったら元画像の参照を手放す
+        # （元解像度のタグの切り出しは小さく、以降の検索で使うため保持）
+        if self.buffer is not None:
+            self.buffer.release()
+    
+    def item(self, row):
+        
+        # 従来の辞書形式の表現（1件分）
+        row = int(row)
+        return {
+            "index": row + 1,
+            "original_index": int(self.original_indices[row]),
+            "filepath": self.filepaths[row] if self.filepaths is not None else None,
+            "label": self.label(row),
+            "class": self.class_name(row),
+            "score": float(self.scores[row]),
+            "box": self.boxes[row],
+            "filtered": bool(self.filtered[row])
+        }
+    
+    def to_arrays(self):
+        
+        return {
+            "boxes": self.boxes,
+            "scores": self.scores,
+            "label_ids": self.label_ids,
+            "class_ids": self.class_ids,
+            "filtered": self.filtered,
+            "original_indices": self.original_indices,
+            "pair_index": self.pair_index,
+            "pair_distance": self.pair_distance
+        }
+    
+    @classmethod
+    def from_arrays(cls, arrays, label_names, image=None, filepaths=None, image_size=None, full_resolution=None):
+        
+        detections = cls(
+            image,
+            arrays["boxes"],
+            arrays["scores"],
+            [label_names[i] for i in arrays["label_ids"]],
+            class_ids=arrays["class_ids"],
+            filtered=arrays["filtered"],
+            original_indices=arrays["original_indices"],
+            filepaths=filepaths,
+            image_size=image_size,
+            full_resolution=full_resolution
+        )
+        detections.pair_index = np.asarray(arrays["pair_index"], dtype=np.int32)
+        detections.pair_distance = np.asarray(arrays["pair_distance"], dtype=np.float32)
+        return detections
@@ -1,29 +1,50 @@
 import os
 import json
+import logging
 import warnings
+import numpy as np
 from object_detector import ObjectDetector
 from barcode_reader import BarcodeReader
 from pairing import ProductTagPairing
 from visualizer import Visualizer
 from classifier import SigLIPClassifier
+from change_detector import ShelfChangeDetector
+from session import AnalysisSession
+from result_writer import ResultWriter
+from detection_set import PRODUCT, TAG, UNCLASSIFIED
+from perf import recorder
+from profiling import Profiler
 
 # 警告を非表示にする
 warnings.filterwarnings('ignore')
 
+logger = logging.getLogger(__name__)
+
 class DrugstoreDetector:
     
-    def __init__(self):
-        # 各コンポーネントの初期化
-        self.object_detector = ObjectDetector()
+    def __init__(self, profile_dir=None, object_detector=None, siglip_classifier=None, ocr_reader=None):
+        # 各コンポーネントの初期化（モデルを使うコンポーネントは差し替え可能）
+        if object_detector is None:
+            object_detector = ObjectDetector()
+        if siglip_classifier is None:
+            siglip_classifier = SigLIPClassifier()
+        
+        self.object_detector = object_detector
         self.pairing = ProductTagPairing()
         self.visualizer = Visualizer()
-        self.siglip_classifier = SigLIPClassifier()
+        self.siglip_classifier = siglip_classifier
+        self.change_detector = ShelfChangeDetector()
         
         # 商品辞書の初期化
         self.product_registry = {}
         
         # BarcodeReaderを初期化
-        self.barcode_reader = BarcodeReader(self.product_registry)
+        self.barcode_reader = BarcodeReader(self.product_registry, ocr_reader=ocr_reader)
+        
+        # プロファイラ（profile_dirを指定した場合のみ有効）
+        self.profiler = Profiler(profile_dir)
+        self.object_detector.profiler = self.profiler
+        self.siglip_classifier.profiler = self.profiler
     
     def register_product(self, product_name, reference_image_path, barcode=None):
         
@@ -31,189 +52,177 @@ class DrugstoreDetector:
             'image_path': reference_image_path,
             'barcode': barcode
         }
-        print(f"商品を登録: {product_name} -> {reference_image_path}" + (f" (バーコード: {barcode})" if barcode else ""))
+        logger.info("商品を登録: %s -> %s%s", product_name, reference_image_path, f" (バーコード: {barcode})" if barcode else "")
     
-    def process_all_objects(self, cropped_images, target_product_name=None):
+    def detect_objects_incremental(self, image_path, state_path, text_prompt, threshold=None):
         
-        print(f"\n画像内容を分析中...")
+        if not os.path.exists(state_path):
+            # 前回の結果がない場合は画像全体を検出
+            logger.info("前回の結果がないため画像全体を検出: %s", state_path)
+            return self.object_detector.detect_objects(image_path, text_prompt, threshold=threshold)
+        
+        image = self.object_detector.load_image(image_path)
+        full_resolution = self.object_detector.open_full_resolution(image_path, image)
+        
+        previous_state = self.change_detector.load_state(state_path)
+        logger.info("\n前回画像との差分を検出中: %s", previous_state['image_path'])
+        
+        # 前回画像は状態と一緒に保存した位置合わせ用画像を使う（元のパスは上書きされている可能性がある）
+        previous_image = previous_state['alignment_image']
+        homography = None
+        if previous_image is None:
+            logger.warning("前回の位置合わせ用画像がありません: %s", state_path)
+        else:
+            with recorder.stage("change.align"):
+                homography = self.change_detector.align(previous_image, image)
+        
+        if homography is None:
+            logger.warning("前回画像と位置合わせできないため画像全体を検出")
+            results = self.object_detector.detect_objects_in_image(image, text_prompt, threshold=threshold)
+            results["full_resolution"] = full_resolution
+            return results
+        
+        with recorder.stage("change.regions"):
+            regions = self.change_detector.find_changed_regions(previous_image, image, homography)
+        logger.info("  変化領域: %d個", len(regions))
+        
+        # 変化のない物体は前回の結果を引き継ぎ、変化領域のみ再検出
+        carried_objects = self.change_detector.carry_over_objects(previous_state, homography, regions, image.size)
+        region_results = self.object_detector.detect_objects_in_regions(
+            image,
+            [self.change_detector.expand_region(region, image.size) for region in regions],
+            text_prompt,
+            threshold=threshold
+        )
+        
+        results = self.change_detector.merge_detections(image, carried_objects, region_results, regions)
+        results["full_resolution"] = full_resolution
+        return results
+    
+    def save_shelf_state(self, image_path, session, target_product_name, state_path):
+        
+        # 次回の位置合わせに元画像の画素を使うため、元画像を解放する前に呼び出す
+        state, embeddings = self.change_detector.build_state(
+            image_path,
+            session.detections.image_size,
+            session,
+            target_product_name
+        )
+        alignment_image = session.detections.image
+        if alignment_image is None:
+            logger.warning("元画像を解放済みのため位置合わせ用画像を保存できません（次回は画像全体を検出）")
+        self.change_detector.save_state(state, state_path, embeddings, alignment_image=alignment_image)
+    
+    def create_session(self, detections):
+        
+        logger.info("\n画像内容を分析中...")
         
         # 除外されていないオブジェクトのみ処理
-        active_images = [item for item in cropped_images if not item.get('filtered', False)]
-        filtered_images = [item for item in cropped_images if item.get('filtered', False)]
+        active_rows = detections.rows()
         
-        print(f"処理対象: {len(active_images)}個 (除外: {len(filtered_images)}個)")
+        logger.info("処理対象: %d個 (除外: %d個)", len(active_rows), len(detections) - len(active_rows))
         
         # Grounding DINOのラベルから分類結果を表示
-        unclassified_count = 0
-        for item in active_images:
-            if item['class'] is None:
-                unclassified_count += 1
-            print(f"[{item['index']}/{len(cropped_images)}] ラベル: {item['label']} → 分類: {item['class']}")
+        if logger.isEnabledFor(logging.DEBUG):
+            for row in active_rows:
+                logger.debug("[%d/%d] ラベル: %s → 分類: %s", row + 1, len(detections), detections.label(row), detections.class_name(row))
         
         # Grounding DINOで分類できなかったオブジェクトをSigLIPで分類
-        if unclassified_count > 0:
-            print(f"\n{unclassified_count}個の未分類オブジェクトをSigLIPで分類中...")
-            for item in active_images:
-                if item['class'] is None:
-                    print(f"[{item['index']}] SigLIPで分類中: {item['label']}")
-                    classified, probs = self.siglip_classifier.classify_image(item['filepath'], return_probs=True)
+        unclassified_rows = detections.rows(UNCLASSIFIED)
+        if len(unclassified_rows) > 0:
+            logger.info("\n%d個の未分類オブジェクトをSigLIPで分類中...", len(unclassified_rows))
+            # 全オブジェクトの分類をまとめて1つのトレースとしてプロファイル
+            with self.profiler.torch_section("siglip_classify"):
+                for row in unclassified_rows:
+                    if detections.carried_object(row):
+                        # 前回も未分類だった物体は再分類しない
+                        continue
+                    logger.debug("[%d] SigLIPで分類中: %s", row + 1, detections.label(row))
+                    with recorder.stage("classify"):
+                        classified, probs = self.siglip_classifier.classify_image(detections.crop(row), return_probs=True)
                     # productと判定された場合のみクラスを付与
                     if classified == 'product':
-                        item['class'] = 'product'
-                        print(f"  → product")
-                        print(f"     確率: 商品={probs['product']:.1%}, タグ={probs['tag']:.1%}")
+                        detections.class_ids[row] = PRODUCT
+                        logger.debug("  → product")
                     else:
-                        print(f"  → 未分類のまま (tag判定)")
-                        print(f"     確率: 商品={probs['product']:.1%}, タグ={probs['tag']:.1%}")
+                        logger.debug("  → 未分類のまま (tag判定)")
+                    logger.debug("     確率: 商品=%.1f%%, タグ=%.1f%%", probs['product'] * 100, probs['tag'] * 100)
         else:
-            print(f"\nすべてのオブジェクトがGrounding DINOで分類されました")
+            logger.info("\nすべてのオブジェクトがGrounding DINOで分類されました")
         
         # 商品とタグをペアリング
-        pairing_result = self.pairing.pair_products_and_tags(cropped_images)
-        
-        # 分類結果でフィルタリング
-        product_images = [item for item in active_images if item['class'] == 'product']
-        tag_images = [item for item in active_images if item['class'] == 'tag']
+        pairing_result = self.pairing.pair_products_and_tags(detections)
         
-        print(f"\n最終分類結果: product={len(product_images)}個, tag={len(tag_images)}個")
+        product_rows = detections.rows(PRODUCT)
+        tag_rows = detections.rows(TAG)
         
-        results = []
+        logger.info("\n最終分類結果: product=%d個, tag=%d個", len(product_rows), len(tag_rows))
         
-        # 除外されたオブジェクトを結果に追加
-        for item in filtered_images:
-            results.append({
-                "index": item['index'],
-                "class": item.get('class', 'filtered'),
-                "label": item['label'],
-                "width_ratio": item.get('width_ratio'),
-                "height_ratio": item.get('height_ratio'),
-                "matched": False,
-                "paired_with": None,
-                "barcode_verified": None,
-                "barcode_data": None
-            })
+        # 商品の埋め込みをまとめて計算（前回から引き継いだ商品は再計算しない）
+        carried_embeddings = [
+            (detections.carried_object(row) or {}).get('embedding') for row in product_rows
+        ]
+        pending = [i for i, embedding in enumerate(carried_embeddings) if embedding is None]
+        logger.info("SigLIPで商品の特徴量を抽出中: %d個 (引き継ぎ: %d個)", len(pending), len(product_rows) - len(pending))
+        with recorder.stage("match.embed"):
+            encoded = self.siglip_classifier.encode_images([detections.crop(product_rows[i]) for i in pending])
         
-        # ペアリング情報を含めてタグを追加
-        for item in tag_images:
-            paired_product_index = None
-            for pair in pairing_result['pairs']:
-                if pair['tag']['index'] == item['index']:
-                    paired_product_index = pair['product']['index']
-                    break
-            
-            results.append({
-                "index": item['index'],
-                "class": "tag",
-                "label": item['label'],
-                "matched": False,
-                "paired_with": paired_product_index,
-                "barcode_verified": None,
-                "barcode_data": None
-            })
+        product_embeddings = np.zeros((len(product_rows), encoded.shape[1]), dtype=np.float32)
+        product_embeddings[pending] = encoded
+        for i, embedding in enumerate(carried_embeddings):
+            if embedding is not None:
+                product_embeddings[i] = embedding
         
-        # 特定商品の検索が指定されている場合、SigLIPで商品マッチング
-        matched_products = []
-        if target_product_name:
-            print(f"\nproductクラス({len(product_images)}個)から '{target_product_name}' を検索中...")
-            
-            # 辞書から参照画像を取得
-            if target_product_name not in self.product_registry:
-                print(f"    警告: '{target_product_name}'は登録されていません")
-            else:
-                reference_image_path = self.product_registry[target_product_name]['image_path']
-                
-                # SigLIPで商品マッチング
-                print(f"  SigLIPで商品マッチングを実行...")
-                for item in product_images:
-                    print(f"[{item['index']}] 判定中: {item['label']}")
-                    try:
-                        is_match, similarity = self.siglip_classifier.match_product_images(
-                            reference_image_path,
-                            item['filepath'],
-                            return_similarity=True
-                        )
-                        if is_match:
-                            print(f"    ✓ 一致 (類似度: {similarity:.3f})")
-                            matched_products.append(item)
-                        else:
-                            print(f"    ✗ 不一致 (類似度: {similarity:.3f})")
-                    except Exception as e:
-                        print(f"    エラー: {e}")
-                
-                print(f"\n検索結果: {len(matched_products)}個の一致する商品が見つかりました")
-                
-                # 一致した商品のタグからバーコードを検証
-                if matched_products:
-                    print(f"\n一致した商品のバーコード検証を開始...")
-                    for item in matched_products:
-                        # ペアになっているタグを探す
-                        paired_tag = None
-                        for pair in pairing_result['pairs']:
-                            if pair['product']['index'] == item['index']:
-                                paired_tag = pair['tag']
-                                break
-                        
-                        if paired_tag:
-                            print(f"\n商品#{item['index']}のペアタグ#{paired_tag['index']}を検証中...")
-                            verified, barcode_data = self.barcode_reader.verify_product_by_barcode(
-                                paired_tag['filepath'],
-                                target_product_name
-                            )
-                            
-                            # 検証結果を保存
-                            item['barcode_verified'] = verified
-                            item['barcode_data'] = barcode_data
-                            
-                            # タグの情報も更新
-                            for tag_result in results:
-                                if tag_result['index'] == paired_tag['index']:
-                                    tag_result['barcode_verified'] = verified
-                                    tag_result['barcode_data'] = barcode_data
-                                    break
-                        else:
-                            print(f"\n商品#{item['index']}: ペアのタグが見つかりませんでした")
-                            item['barcode_verified'] = None
-                            item['barcode_data'] = None
+        # 前回読み取ったJANコードを引き継ぐ
+        tag_barcodes = {}
+        for row in tag_rows:
+            carried = detections.carried_object(row)
+            if carried and 'barcode_data' in carried:
+                tag_barcodes[int(row)] = carried['barcode_data']
         
-        # 結果を整形（ペアリング情報とバーコード検証結果を含む）
-        for item in product_images:
-            is_matched = item in matched_products if target_product_name else False
-            
-            # ペアになっているタグのインデックスを取得
-            paired_tag_index = None
-            for pair in pairing_result['pairs']:
-                if pair['product']['index'] == item['index']:
-                    paired_tag_index = pair['tag']['index']
-                    break
-            
-            results.append({
-                "index": item['index'],
-                "class": "product",
-                "label": item['label'],
-                "matched": is_matched,
-                "paired_with": paired_tag_index,
-                "barcode_verified": item.get('barcode_verified'),
-                "barcode_data": item.get('barcode_data')
-            })
+        return AnalysisSession(
+            detections,
+            pairing_result,
+            product_embeddings,
+            self.siglip_classifier,
+            self.barcode_reader,
+            self.product_registry,
+            tag_barcodes=tag_barcodes
+        )
+    
+    def open_session(self, session_dir):
         
-        print(f"\n全{len(results)}個のオブジェクトの処理が完了(product: {len(product_images)}個, tag: {len(tag_images)}個)")
+        return AnalysisSession.load(session_dir, self.siglip_classifier, self.barcode_reader, self.product_registry)
+    
+    def process_all_objects(self, detections, target_product_name=None):
         
-        return results, matched_products, pairing_result
+        session = self.create_session(detections)
+        return session.search(target_product_name)
     
     def save_results_to_json(self, results, output_path="output/results1.json"):
         """結果をJSONファイルに保存"""
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
         
-        with open(output_path, 'w', encoding='utf-8') as f:
+        with recorder.stage("output.json"), open(output_path, 'w', encoding='utf-8') as f:
             json.dump(results, f, ensure_ascii=False, indent=2)
         
-        print(f"\n結果をJSONファイルに保存: {output_path}")
+        logger.info("\n結果をJSONファイルに保存: %s", output_path)
 
 
 def main():
     
+    # ログレベル（DEBUGで物体ごとの詳細を表示）
+    logging.basicConfig(level=os.environ.get("DETECT_LOG_LEVEL", "INFO"), format="%(message)s")
+    
+    # パフォーマンスレポートの保存先
+    perf_report_path = "output/perf_report1.json"
+    recorder.reset()
+    
+    # プロファイルの保存先（環境変数で指定した場合のみ有効）
+    profile_dir = os.environ.get("DETECT_PROFILE_DIR")
+    
     # 検出器の初期化
-    detector = DrugstoreDetector()
+    detector = DrugstoreDetector(profile_dir=profile_dir)
     
     # 商品の登録（商品名、参照画像、バーコード番号）
     # detector.register_product("アレグラFX28錠", "input/reference/allegra_fx_28.jpg", "230606349269")
@@ -237,72 +246,120 @@ def main():
     max_width_ratio = 0.8 
     max_height_ratio = 0.8
     
+    # 切り出し前に除去するボックス（最小の幅・高さ、同じクラスで重なるボックスのIoU）
+    min_box_size = 8
+    nms_iou_threshold = 0.7
+    
+    # 検出結果画像の長辺の上限（指定すると縮小したプレビューのみ保存）
+    preview_max_size = None  # 例: 1280
+    
+    # 1行1オブジェクトのNDJSONと列形式（Parquet、pyarrowがない場合は.npz）の出力先
+    ndjson_path = "output/results1.ndjson"
+    columnar_path = None  # 例: "output/results1.parquet"
+    
     # 検索する商品名
     target_product_name = "AGアレルカットc15ml" 
     
+    # 同じ棚の前回結果（指定すると変化した領域のみ再処理）
+    shelf_state_path = None  # 例: "output/shelf_state1.json"
+    
+    # 分析セッションの保存先（保存すると別の商品を再検出なしで検索可能）
+    session_dir = None  # 例: "output/session1"
+    
     # 物体検出の実行
-    print(f"\n画像を解析中: {image_path}")
-    detection_results = detector.object_detector.detect_objects(
-        image_path=image_path,
-        text_prompt=text_prompt,
-        threshold=0.18
-    )
+    logger.info("\n画像を解析中: %s", image_path)
+    with detector.profiler.python_section("detect"):
+        if shelf_state_path:
+            detection_results = detector.detect_objects_incremental(
+                image_path,
+                shelf_state_path,
+                text_prompt,
+                threshold=0.18
+            )
+        else:
+            detection_results = detector.object_detector.detect_objects(
+                image_path=image_path,
+                text_prompt=text_prompt,
+                threshold=0.18
+            )
     
     # 結果のサマリーを表示
     detector.visualizer.print_detection_summary(detection_results)
     
-    # 結果を可視化して保存
-    output_path = "output/result_specific1.jpeg"
-    detector.visualizer.visualize_results(detection_results, save_path=output_path, show=False)
+    # 検出されたオブジェクトを個別に保存（重複・小さすぎるボックスは除去）
+    with detector.profiler.python_section("crop"):
+        detections = detector.object_detector.crop_detected_objects(
+            detection_results, 
+            max_objects=max_objects,
+            max_width_ratio=max_width_ratio,
+            max_height_ratio=max_height_ratio,
+            min_box_size=min_box_size,
+            nms_iou_threshold=nms_iou_threshold
+        )
     
-    # 検出されたオブジェクトを個別に保存
-    cropped_images = detector.object_detector.crop_detected_objects(
-        detection_results, 
-        max_objects=max_objects,
-        max_width_ratio=max_width_ratio,
-        max_height_ratio=max_height_ratio
-    )
+    # 以降は共有バッファの配列を使うため、検出用のPIL画像は手放す（デコード済みの画像を2枚保持しない）
+    detection_results["image"] = None
     
-    processed_results, matched_products, pairing_result = detector.process_all_objects(
-        cropped_images, 
-        target_product_name=target_product_name
-    )
+    # 分類・ペアリング・特徴量抽出をまとめたセッションを作成して検索
+    with detector.profiler.python_section("session"):
+        session = detector.create_session(detections)
+    with detector.profiler.python_section("search"):
+        processed_results, matched_products, pairing_result = session.search(target_product_name)
     
     # 結果のサマリーを表示
     detector.visualizer.print_summary(processed_results)
     
-    # 一致した商品のバウンディングボックスを可視化（バーコード一致のみ）
-    matched_output_path = None
+    # バーコードが一致した商品のみをフィルタリング
+    barcode_verified_products = [
+        item for item in matched_products 
+        if item.get('barcode_verified') == True
+    ]
     if target_product_name and matched_products:
-        # バーコードが一致した商品のみをフィルタリング
-        barcode_verified_products = [
-            item for item in matched_products 
-            if item.get('barcode_verified') == True
-        ]
-        
         if barcode_verified_products:
-            matched_output_path = "output/result_matched1.jpeg"
-            detector.visualizer.visualize_matched_products(
-                detection_results, 
-                barcode_verified_products, 
-                save_path=matched_output_path, 
-                show=False
-            )
-            print(f"\nバーコード一致した商品: {len(barcode_verified_products)}個")
+            logger.info("\nバーコード一致した商品: %d個", len(barcode_verified_products))
         else:
-            print(f"\nバーコードが一致した商品はありませんでした")
+            logger.info("\nバーコードが一致した商品はありませんでした")
+    
+    # 全検出結果とバーコード一致した商品を1枚に描画（番号は結果のJSONと同じ）
+    output_path = "output/result_specific1.jpeg"
+    with recorder.stage("visualize"), detector.profiler.python_section("visualize"):
+        detector.visualizer.render(
+            detections,
+            barcode_verified_products,
+            save_path=output_path,
+            max_size=preview_max_size
+        )
+    
+    # 次回の差分検出のために棚の状態を保存（位置合わせ用に元画像を使うため解放前に保存）
+    if shelf_state_path:
+        detector.save_shelf_state(image_path, session, target_product_name, shelf_state_path)
+    
+    # 元画像を使う処理が終わったので解放（以降の切り出しは保存済みファイルから読み込む）
+    detections.release_image()
     
     # 結果をJSONファイルに保存
     detector.save_results_to_json(processed_results)
     
-    print(f"\n処理完了")
-    print(f"  全検出結果画像: {output_path}")
-    if matched_output_path:
-        print(f"  一致商品画像: {matched_output_path}")
-    print(f"  ペアリング結果:")
-    print(f"    ペア数: {len(pairing_result['pairs'])}")
-    print(f"    未ペア商品: {len(pairing_result['unpaired_products'])}")
-    print(f"    未ペアタグ: {len(pairing_result['unpaired_tags'])}")
+    # 画像IDつきの行形式（NDJSON）・列形式で保存
+    with ResultWriter(ndjson_path, columnar_path) as writer:
+        writer.write(image_path, processed_results)
+    
+    if session_dir:
+        session.save(session_dir)
+    
+    # ステージごとの時間とカウンタをJSONで保存
+    recorder.save_report(perf_report_path, image_path=image_path, target_product_name=target_product_name)
+    
+    logger.info("\n処理完了")
+    logger.info("  検出結果画像: %s", output_path)
+    logger.info("  ペアリング結果:")
+    logger.info("    ペア数: %d", len(pairing_result['pairs']))
+    logger.info("    未ペア商品: %d", len(pairing_result['unpaired_products']))
+    logger.info("    未ペアタグ: %d", len(pairing_result['unpaired_tags']))
+    logger.info("  NDJSON: %s", ndjson_path)
+    if columnar_path:
+        logger.info("  列形式: %s", columnar_path)
+    logger.info("  パフォーマンスレポート: %s", perf_report_path)
     
     return detector, detection_results, matched_products, pairing_result
 
@@ -1,7 +1,15 @@
 import torch
+import numpy as np
 from PIL import Image
 import os
+import logging
 from transformers import AutoProcessor, AutoModelForZeroShotObjectDetection
+from detection_set import DetectionSet, FullResolutionSource, CLASS_NAMES, class_id_from_label
+from box_filter import prefilter_boxes
+from perf import recorder
+from profiling import Profiler
+
+logger = logging.getLogger(__name__)
 
 
 class ObjectDetector:
@@ -11,50 +19,122 @@ class ObjectDetector:
         self.device = "mps"
         self.model_id = "models/grounding-dino-base"
         
+        # JPEGをDCT領域で縮小しながらデコードする（検出用の画像のみ）
+        self.reduced_decode = True
+        
+        # プロファイラ（既定は無効）
+        self.profiler = Profiler()
+        
         # Grounding DINO の読み込み
-        print("物体検出モデルを読み込み中...")
-        self.processor = AutoProcessor.from_pretrained(self.model_id)
-        self.model = AutoModelForZeroShotObjectDetection.from_pretrained(self.model_id).to(self.device)
-        print("物体検出モデルの読み込みが完了")
+        logger.info("物体検出モデルを読み込み中...")
+        with recorder.stage("model_load.grounding_dino"):
+            self.processor = AutoProcessor.from_pretrained(self.model_id)
+            self.model = AutoModelForZeroShotObjectDetection.from_pretrained(self.model_id).to(self.device)
+        logger.info("物体検出モデルの読み込みが完了")
+    
+    def load_image(self, image_path, max_size=None):
+        
+        if max_size is None:
+            max_size = 2304
+        
+        with recorder.stage("decode"):
+            # 画像の読み込み
+            image = Image.open(image_path)
+            
+            if self.reduced_decode and max(image.size) > max_size:
+                # 長辺がmax_size以上に収まる範囲で1/2, 1/4, 1/8のスケールでデコード
+                ratio = max_size / max(image.size)
+                original_size = image.size
+                image.draft("RGB", (round(original_size[0] * ratio), round(original_size[1] * ratio)))
+                if image.size != original_size:
+                    logger.info("縮小デコード: %s → %s", original_size, image.size)
+            
+            image = image.convert("RGB")
+            
+            if max(image.size) > max_size:
+                image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+                logger.info("画像をリサイズ: %s", image.size)
+        
+        return image
+    
+    def open_full_resolution(self, image_path, image):
+        
+        # 細部が必要な切り出し（バーコードのタグなど）用に元解像度の画像を遅延して参照
+        return FullResolutionSource(image_path, image.size)
     
     def detect_objects(self, image_path, text_prompt, threshold=None):
         
+        image = self.load_image(image_path)
+        results = self.detect_objects_in_image(image, text_prompt, threshold=threshold)
+        results["full_resolution"] = self.open_full_resolution(image_path, image)
+        return results
+    
+    def detect_objects_in_image(self, image, text_prompt, threshold=None):
+        
         if threshold is None:
             threshold = 0.18
         
-        # 画像の読み込み
-        image = Image.open(image_path).convert("RGB")
-
-        max_size = 2304
-        if max(image.size) > max_size:
-            image.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-            print(f"画像をリサイズ: {image.size}")
-        
         # 入力の準備
-        inputs = self.processor(images=image, text=text_prompt, return_tensors="pt").to(self.device)
+        with recorder.stage("detect.preprocess"):
+            inputs = self.processor(images=image, text=text_prompt, return_tensors="pt").to(self.device)
         
         # 推論
-        with torch.no_grad():
+        with recorder.stage("detect.forward"), self.profiler.torch_section("grounding_dino"), torch.no_grad():
             outputs = self.model(**inputs)
         
         # 結果の後処理
-        results = self.processor.post_process_grounded_object_detection(
-            outputs,
-            inputs.input_ids,
-            threshold=threshold,
-            target_sizes=[image.size[::-1]]
-        )[0]
+        with recorder.stage("detect.postprocess"):
+            results = self.processor.post_process_grounded_object_detection(
+                outputs,
+                inputs.input_ids,
+                threshold=threshold,
+                target_sizes=[image.size[::-1]]
+            )[0]
+            boxes = results["boxes"].cpu().numpy()
+            scores = results["scores"].cpu().numpy()
+        
+        recorder.count("detections", len(boxes))
         
         return {
             "image": image,
-            "boxes": results["boxes"].cpu().numpy(),
-            "scores": results["scores"].cpu().numpy(),
+            "boxes": boxes,
+            "scores": scores,
             "labels": results["labels"]
         }
     
+    def detect_raw_in_image(self, image, text_prompt):
+        
+        # 閾値で絞り込む前の全クエリの出力（閾値の調整用にキャッシュする）
+        return self.detect_objects_in_image(image, text_prompt, threshold=0.0)
+    
+    def detect_objects_in_regions(self, image, regions, text_prompt, threshold=None):
+        
+        boxes = []
+        scores = []
+        labels = []
+        
+        # 全領域の推論をまとめて1つのトレースとしてプロファイル
+        with self.profiler.torch_section("grounding_dino"):
+            for x1, y1, x2, y2 in regions:
+                # 領域ごとに検出し、座標を画像全体の座標系に戻す
+                region_results = self.detect_objects_in_image(image.crop((x1, y1, x2, y2)), text_prompt, threshold=threshold)
+                if len(region_results["boxes"]) == 0:
+                    continue
+                boxes.append(region_results["boxes"] + np.array([x1, y1, x1, y1], dtype=np.float32))
+                scores.append(region_results["scores"])
+                labels.extend(region_results["labels"])
+        
+        return {
+            "image": image,
+            "boxes": np.concatenate(boxes) if boxes else np.zeros((0, 4), dtype=np.float32),
+            "scores": np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32),
+            "labels": labels
+        }
+    
     def crop_detected_objects(self, results, output_dir="output/cropped1", 
                              max_objects=None, max_width_ratio=None, 
-                             max_height_ratio=None, padding_ratio=None):
+                             max_height_ratio=None, padding_ratio=None,
+                             min_box_size=None, nms_iou_threshold=None):
         
         if max_width_ratio is None:
             max_width_ratio = 0.8
@@ -62,101 +142,99 @@ class ObjectDetector:
             max_height_ratio = 0.8
         if padding_ratio is None:
             padding_ratio = 0.1
+        if min_box_size is None:
+            min_box_size = 8
+        if nms_iou_threshold is None:
+            nms_iou_threshold = 0.7
         
-        print(f"\n検出されたオブジェクトを切り出し中...")
+        logger.info("\n検出されたオブジェクトを切り出し中...")
         
         # 出力ディレクトリの作成
         os.makedirs(output_dir, exist_ok=True)
         
-        image = results["image"]
-        image_width, image_height = image.size
-        
-        cropped_images = []
-        
-        # インデックスのリストを作成
-        indices = list(range(len(results["boxes"])))
+        count = len(results["boxes"])
         
         # max_objectsが指定されている場合は制限
         if max_objects:
-            indices = indices[:max_objects]
-            print(f"上位{max_objects}個のオブジェクトのみ処理")
-        
-        filtered_count = 0
-        saved_count = 0
-        for rank, idx in enumerate(indices, 1):
-            box = results["boxes"][idx]
-            score = results["scores"][idx]
-            label = results["labels"][idx]
-            x1, y1, x2, y2 = map(int, box)
-            
-            # バウンディングボックスのサイズをチェック
-            box_width = x2 - x1
-            box_height = y2 - y1
-            width_ratio = box_width / image_width
-            height_ratio = box_height / image_height
-            
-            # バウンディングボックスで切り出し
-            cropped = image.crop((x1, y1, x2, y2))
-            
-            # 大きすぎるかチェック
-            is_filtered = width_ratio > max_width_ratio or height_ratio > max_height_ratio
-            
-            # Grounding DINOのラベルから分類を決定
-            detected_class = None
-            if "product" in label.lower():
-                detected_class = "product"
-            elif "tag" in label.lower():
-                detected_class = "tag"
-            
-            # ファイル名を生成
-            prefix = "filtered_" if is_filtered else ""
-            filename = f"{prefix}object_{saved_count+1:03d}_{label}_{score:.2f}.png"
-            filepath = os.path.join(output_dir, filename)
+            count = min(count, max_objects)
+            logger.info("上位%d個のオブジェクトのみ処理", max_objects)
+        
+        image_size = results["image"].size
+        labels = list(results["labels"][:count])
+        carried = results["carried"][:count] if "carried" in results else None
+        
+        # 切り出し前にまとめて座標の補正・サイズの判定・重複の除去を行う
+        with recorder.stage("prefilter"):
+            scores = np.asarray(results["scores"][:count], dtype=np.float32)
             
-            # 保存（除外される場合もデバッグ用に保存）
-            cropped.save(filepath)
-            saved_count += 1
+            # 前回の結果から引き継いだ物体は前回の分類を使用
+            class_ids = np.array([class_id_from_label(label) for label in labels], dtype=np.int8)
+            if carried is not None:
+                for row, obj in enumerate(carried):
+                    if obj and obj.get('class'):
+                        class_ids[row] = CLASS_NAMES.index(obj['class'])
             
-            if is_filtered:
-                filtered_count += 1
+            boxes, keep, too_large, large_enough = prefilter_boxes(
+                np.asarray(results["boxes"][:count], dtype=np.float32).reshape(count, 4),
+                scores,
+                class_ids,
+                image_size,
+                max_width_ratio,
+                max_height_ratio,
+                min_box_size,
+                nms_iou_threshold
+            )
+        
+        too_small_count = count - int(large_enough.sum())
+        suppressed_count = int(large_enough.sum()) - len(keep)
+        recorder.count("boxes_too_small", too_small_count)
+        recorder.count("boxes_suppressed", suppressed_count)
+        
+        detections = DetectionSet(
+            results["image"],
+            boxes[keep],
+            scores[keep],
+            [labels[i] for i in keep],
+            class_ids=class_ids[keep],
+            filtered=too_large[keep],
+            original_indices=keep,
+            carried=[carried[i] for i in keep] if carried is not None else None,
+            full_resolution=results.get("full_resolution")
+        )
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            width_ratios = detections.width_ratios
+            height_ratios = detections.height_ratios
+            for row in np.flatnonzero(detections.filtered):
                 reason = []
-                if width_ratio > max_width_ratio:
-                    reason.append(f"幅比 {width_ratio:.2%} > {max_width_ratio:.2%}")
-                if height_ratio > max_height_ratio:
-                    reason.append(f"高さ比 {height_ratio:.2%} > {max_height_ratio:.2%}")
-                print(f"  [除外] オブジェクト{rank}: {', '.join(reason)} → {filename} ")
-                cropped_images.append({
-                    "index": len(cropped_images) + 1,
-                    "original_index": int(idx),
-                    "filepath": filepath,
-                    "label": label,
-                    "class": detected_class,
-                    "score": float(score),
-                    "box": box,
-                    "width_ratio": width_ratio,
-                    "height_ratio": height_ratio,
-                    "filtered": True,
-                    "image": cropped
-                })
-            else:
-                cropped_images.append({
-                    "index": len(cropped_images) + 1,
-                    "original_index": int(idx),
-                    "filepath": filepath,
-                    "label": label,
-                    "class": detected_class,
-                    "score": float(score),
-                    "box": box,
-                    "width_ratio": width_ratio,
-                    "height_ratio": height_ratio,
-                    "filtered": False,
-                    "image": cropped
-                })
-        
+                if width_ratios[row] > max_width_ratio:
+                    reason.append(f"幅比 {width_ratios[row]:.2%} > {max_width_ratio:.2%}")
+                if height_ratios[row] > max_height_ratio:
+                    reason.append(f"高さ比 {height_ratios[row]:.2%} > {max_height_ratio:.2%}")
+                logger.debug("  [除外] オブジェクト%d: %s", row + 1, ', '.join(reason))
+        
+        # 残ったオブジェクトのみ切り出して保存
+        filepaths = [None] * len(detections)
+        with recorder.stage("crop"):
+            for row in detections.rows():
+                filename = f"object_{row+1:03d}_{detections.label(row)}_{detections.scores[row]:.2f}.png"
+                filepath = os.path.join(output_dir, filename)
+                detections.crop(row).save(filepath)
+                filepaths[row] = filepath
+        
+        detections.filepaths = filepaths
+        crop_count = len(detections.rows())
+        recorder.count("crops_written", crop_count)
+        
+        filtered_count = int(detections.filtered.sum())
+        if too_small_count > 0:
+            logger.info("%d個の小さすぎるボックスを除去", too_small_count)
+        if suppressed_count > 0:
+            logger.info("%d個の重複ボックスを除去", suppressed_count)
         if filtered_count > 0:
-            print(f"{filtered_count}個のオブジェクトを除外")
-        print(f"{len(cropped_images)}個のオブジェクトを保存: {output_dir}")
-        print(f"  検索対象: {len([x for x in cropped_images if not x.get('filtered', False)])}個")
-        print(f"  除外: {len([x for x in cropped_images if x.get('filtered', False)])}個")
+            logger.info("%d個のオブジェクトを除外", filtered_count)
+        logger.info("%d個のオブジェクトを保存: %s", crop_count, output_dir)
+        logger.info("  検索対象: %d個", crop_count)
+        logger.info("  除外: %d個", filtered_count)
         
-        return cropped_images
+        return detections
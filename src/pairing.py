@@ -1,4 +1,9 @@
+import logging
 import numpy as np
+from detection_set import PRODUCT, TAG
+from perf import recorder
+
+logger = logging.getLogger(__name__)
 
 
 class ProductTagPairing:
@@ -12,90 +17,88 @@ class ProductTagPairing:
         self.horizontal_distance_factor = horizontal_distance_factor
         self.max_pairing_distance = max_pairing_distance
     
-    def pair_products_and_tags(self, cropped_images):
+    def pair_products_and_tags(self, detections):
+        
+        with recorder.stage("pair"):
+            return self._pair_products_and_tags(detections)
+    
+    def _pair_products_and_tags(self, detections):
         
-        print(f"\n商品とタグのペアリングを開始...")
+        logger.info("\n商品とタグのペアリングを開始...")
         
         # 商品とタグに分類
-        products = [item for item in cropped_images if item.get('class') == 'product' and not item.get('filtered', False)]
-        tags = [item for item in cropped_images if item.get('class') == 'tag' and not item.get('filtered', False)]
-        
-        print(f"商品: {len(products)}個, タグ: {len(tags)}個")
-        
-        pairs = []
-        unpaired_products = []
-        
-        for product in products:
-            product_box = product['box']
-            # 商品の下底の中心座標
-            product_bottom_center_x = (product_box[0] + product_box[2]) / 2
-            product_bottom_y = product_box[3]  # 下底のy座標
-            
-            best_tag = None
-            min_distance = float('inf')
-            
-            for tag in tags:
-                tag_box = tag['box']
-                # タグの上底の中心座標
-                tag_top_center_x = (tag_box[0] + tag_box[2]) / 2
-                tag_top_y = tag_box[1]  # 上底のy座標
-                
-                # 水平方向の距離
-                horizontal_distance = abs(tag_top_center_x - product_bottom_center_x)
-                
-                # 垂直方向の距離
-                vertical_distance = abs(tag_top_y - product_bottom_y)
-                
-                # ユークリッド距離を計算
-                distance = np.sqrt(horizontal_distance**2 + vertical_distance**2)
-                
-                # 水平方向の許容範囲をチェック
-                product_width = product_box[2] - product_box[0]
-                if horizontal_distance > product_width * self.horizontal_distance_factor:
-                    continue
-                
-                # 最大距離制限をチェック
-                if distance > self.max_pairing_distance:
-                    continue
-                
-                if distance < min_distance:
-                    min_distance = distance
-                    best_tag = tag
-            
-            if best_tag:
-                pairs.append({
-                    'product': product,
-                    'tag': best_tag,
-                    'distance': min_distance
-                })
-                print(f"  ペア作成: 商品#{product['index']} ↔ タグ#{best_tag['index']} (距離: {min_distance:.1f})")
-            else:
-                unpaired_products.append(product)
-                print(f"  商品#{product['index']}: 対応するタグが見つかりませんでした")
+        product_rows = detections.rows(PRODUCT)
+        tag_rows = detections.rows(TAG)
+        
+        logger.info("商品: %d個, タグ: %d個", len(product_rows), len(tag_rows))
+        
+        product_boxes = detections.boxes[product_rows]
+        tag_boxes = detections.boxes[tag_rows]
+        
+        # 商品の下底の中心座標とタグの上底の中心座標（商品 × タグ）
+        product_bottom_center_x = (product_boxes[:, 0] + product_boxes[:, 2]) / 2
+        product_bottom_y = product_boxes[:, 3]
+        tag_top_center_x = (tag_boxes[:, 0] + tag_boxes[:, 2]) / 2
+        tag_top_y = tag_boxes[:, 1]
+        
+        # 水平方向・垂直方向の距離とユークリッド距離
+        horizontal_distance = np.abs(tag_top_center_x[None, :] - product_bottom_center_x[:, None])
+        vertical_distance = np.abs(tag_top_y[None, :] - product_bottom_y[:, None])
+        distance = np.sqrt(horizontal_distance**2 + vertical_distance**2)
+        
+        # 水平方向の許容範囲と最大距離制限をチェック
+        product_width = product_boxes[:, 2] - product_boxes[:, 0]
+        valid = (
+            (horizontal_distance <= product_width[:, None] * self.horizontal_distance_factor) &
+            (distance <= self.max_pairing_distance)
+        )
+        distance = np.where(valid, distance, np.inf)
+        
+        # 各商品について最も近いタグを選択
+        detections.pair_index[:] = -1
+        detections.pair_distance[:] = np.nan
+        if len(tag_rows) > 0:
+            best = distance.argmin(axis=1)
+            min_distance = distance[np.arange(len(product_rows)), best]
+            has_tag = np.isfinite(min_distance)
+        else:
+            best = np.zeros(len(product_rows), dtype=np.int64)
+            min_distance = np.full(len(product_rows), np.inf)
+            has_tag = np.zeros(len(product_rows), dtype=bool)
+        
+        paired_products = product_rows[has_tag]
+        paired_tags = tag_rows[best[has_tag]]
+        detections.pair_index[paired_products] = paired_tags
+        detections.pair_distance[paired_products] = min_distance[has_tag]
+        
+        if logger.isEnabledFor(logging.DEBUG):
+            for product_row, tag_row, pair_distance in zip(paired_products, paired_tags, min_distance[has_tag]):
+                logger.debug("  ペア作成: 商品#%d ↔ タグ#%d (距離: %.1f)", product_row + 1, tag_row + 1, pair_distance)
+            for product_row in product_rows[~has_tag]:
+                logger.debug("  商品#%d: 対応するタグが見つかりませんでした", product_row + 1)
         
         # 未ペアタグの計算（複数の商品とペアになるタグもカウント）
-        paired_tag_indices = {pair['tag']['index'] for pair in pairs}
-        unpaired_tags = [tag for tag in tags if tag['index'] not in paired_tag_indices]
+        pairs = np.stack([paired_products, paired_tags], axis=1).astype(np.int32)
+        unpaired_products = product_rows[~has_tag]
+        unpaired_tags = np.setdiff1d(tag_rows, paired_tags)
         
-        print(f"\nペアリング結果:")
-        print(f"  ペア数: {len(pairs)}")
-        print(f"  未ペア商品: {len(unpaired_products)}")
-        print(f"  未ペアタグ: {len(unpaired_tags)}")
+        logger.info("\nペアリング結果:")
+        logger.info("  ペア数: %d", len(pairs))
+        logger.info("  未ペア商品: %d", len(unpaired_products))
+        logger.info("  未ペアタグ: %d", len(unpaired_tags))
         
         # 重複ペアのチェックと表示
-        tag_usage_count = {}
-        for pair in pairs:
-            tag_idx = pair['tag']['index']
-            tag_usage_count[tag_idx] = tag_usage_count.get(tag_idx, 0) + 1
-        
-        duplicate_tags = {idx: count for idx, count in tag_usage_count.items() if count > 1}
-        if duplicate_tags:
-            print(f"\n情報: 以下のタグが複数の商品とペアになっています:")
-            for tag_idx, count in duplicate_tags.items():
-                print(f"  タグ#{tag_idx}: {count}個の商品とペア")
+        tag_usage_rows, tag_usage_count = np.unique(paired_tags, return_counts=True)
+        duplicate = tag_usage_count > 1
+        if duplicate.any():
+            logger.info("\n情報: 以下のタグが複数の商品とペアになっています:")
+            for tag_row, count in zip(tag_usage_rows[duplicate], tag_usage_count[duplicate]):
+                logger.info("  タグ#%d: %d個の商品とペア", tag_row + 1, count)
         
+        # pairsは [商品の行, タグの行] の配列
         return {
             'pairs': pairs,
+            'distances': min_distance[has_tag].astype(np.float32),
             'unpaired_products': unpaired_products,
             'unpaired_tags': unpaired_tags
         }
@@ -0,0 +1,59 @@
+import os
+import json
+import time
+from contextlib import contextmanager
+
+
+class PerfRecorder:
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        
+        # ステージごとの合計時間と呼び出し回数、および各種カウンタ
+        self.stages = {}
+        self.counters = {}
+        self.started_at = time.perf_counter()
+    
+    @contextmanager
+    def stage(self, name):
+        
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+    
+    def add_time(self, name, seconds):
+        
+        stage = self.stages.setdefault(name, {"seconds": 0.0, "calls": 0})
+        stage["seconds"] += seconds
+        stage["calls"] += 1
+    
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+    
+    def report(self, **metadata):
+        
+        return {
+            **metadata,
+            "total_seconds": time.perf_counter() - self.started_at,
+            "stages": {
+                name: {**stage, "mean_seconds": stage["seconds"] / stage["calls"]}
+                for name, stage in sorted(self.stages.items())
+            },
+            "counters": dict(sorted(self.counters.items()))
+        }
+    
+    def save_report(self, output_path, **metadata):
+        
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        report = self.report(**metadata)
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        return report
+
+
+# パイプライン全体で共有する計測器
+recorder = PerfRecorder()
@@ -0,0 +1,86 @@
+import os
+import time
+import logging
+import cProfile
+from contextlib import contextmanager, nullcontext
+
+logger = logging.getLogger(__name__)
+
+
+class Profiler:
+    
+    def __init__(self, output_dir=None):
+        
+        # 出力先を指定した場合のみ有効（無効時は何もしないコンテキストを返す）
+        self.enabled = output_dir is not None
+        self.output_dir = None
+        self.section_counts = {}
+        self._python_active = False
+        self._torch_active = False
+        
+        if self.enabled:
+            # 実行ごとにディレクトリを分ける
+            self.output_dir = os.path.join(output_dir, time.strftime("%Y%m%d-%H%M%S"))
+            os.makedirs(self.output_dir, exist_ok=True)
+            logger.info("プロファイルを有効化: %s", self.output_dir)
+    
+    def _artifact_path(self, name, suffix):
+        
+        count = self.section_counts.get(name, 0) + 1
+        self.section_counts[name] = count
+        return os.path.join(self.output_dir, f"{name}_{count:03d}{suffix}")
+    
+    def torch_section(self, name):
+        
+        # 1回の推論ごとではなくステージ全体で1つのトレースにする（入れ子は外側のセクションのみ計測）
+        if not self.enabled or self._torch_active:
+            return nullcontext()
+        return self._torch_section(name)
+    
+    @contextmanager
+    def _torch_section(self, name):
+        
+        # torchはプロファイル有効時のみ読み込む
+        import torch
+        from torch.profiler import profile, record_function, ProfilerActivity
+        
+        activities = [ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+        
+        self._torch_active = True
+        try:
+            with profile(activities=activities, record_shapes=True) as prof:
+                with record_function(name):
+                    yield
+        finally:
+            self._torch_active = False
+        
+        # Chrome trace形式で保存（chrome://tracing や Perfetto で表示）
+        trace_path = self._artifact_path(name, ".trace.json")
+        prof.export_chrome_trace(trace_path)
+        logger.debug("torchプロファイルを保存: %s", trace_path)
+    
+    def python_section(self, name):
+        
+        # cProfileは入れ子にできないため、外側のセクションのみ計測
+        if not self.enabled or self._python_active:
+            return nullcontext()
+        return self._python_section(name)
+    
+    @contextmanager
+    def _python_section(self, name):
+        
+        self._python_active = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self._python_active = False
+            
+            # pstats形式で保存（python -m pstats や snakeviz で表示）
+            stats_path = self._artifact_path(name, ".pstats")
+            profiler.dump_stats(stats_path)
+            logger.debug("Pythonプロファイルを保存: %s", stats_path)
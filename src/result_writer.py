@@ -0,0 +1,178 @@
+import os
+import json
+import logging
+import numpy as np
+from perf import recorder
+
+logger = logging.getLogger(__name__)
+
+# 列形式の出力の列（1行 = 1オブジェクト）
+COLUMNS = (
+    "image_id", "index", "class", "label", "score", "x1", "y1", "x2", "y2", "filtered",
+    "matched", "similarity", "paired_with", "barcode_verified", "barcode_data"
+)
+
+
+class ColumnarWriter:
+    
+    def __init__(self, output_path, row_group_size=None):
+        
+        if row_group_size is None:
+            row_group_size = 100000
+        
+        self.output_path = output_path
+        self.row_group_size = row_group_size
+        self.chunk_count = 0
+        self._parquet_writer = None
+        self._reset()
+        
+        # pyarrowがあればParquet、なければ列ごとのNumPy配列(.npz)をチャンク単位で保存
+        try:
+            import pyarrow
+            import pyarrow.parquet
+            self.pa = pyarrow
+            self.pq = pyarrow.parquet
+        except ImportError:
+            self.pa = None
+            logger.warning("pyarrowがないため、列形式の結果を.npzで保存します: %s-*.npz", os.path.splitext(output_path)[0])
+        
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    
+    def _reset(self):
+        self.columns = {name: [] for name in COLUMNS}
+        self.row_count = 0
+    
+    def write(self, image_id, results):
+        
+        columns = self.columns
+        for record in results:
+            x1, y1, x2, y2 = record["box"]
+            columns["image_id"].append(image_id)
+            columns["index"].append(record["index"])
+            columns["class"].append(record["class"])
+            columns["label"].append(record["label"])
+            columns["score"].append(record["score"])
+            columns["x1"].append(x1)
+            columns["y1"].append(y1)
+            columns["x2"].append(x2)
+            columns["y2"].append(y2)
+            columns["filtered"].append(record["filtered"])
+            columns["matched"].append(record["matched"])
+            columns["similarity"].append(record["similarity"])
+            columns["paired_with"].append(record["paired_with"])
+            columns["barcode_verified"].append(record["barcode_verified"])
+            columns["barcode_data"].append(record["barcode_data"])
+        self.row_count += len(results)
+        
+        if self.row_count >= self.row_group_size:
+            self.flush()
+    
+    def _parquet_schema(self):
+        
+        pa = self.pa
+        return pa.schema([
+            ("image_id", pa.string()),
+            ("index", pa.int32()),
+            ("class", pa.string()),
+            ("label", pa.string()),
+            ("score", pa.float32()),
+            ("x1", pa.float32()),
+            ("y1", pa.float32()),
+            ("x2", pa.float32()),
+            ("y2", pa.float32()),
+            ("filtered", pa.bool_()),
+            ("matched", pa.bool_()),
+            ("similarity", pa.float32()),
+            ("paired_with", pa.int32()),
+            ("barcode_verified", pa.bool_()),
+            ("barcode_data", pa.string())
+        ])
+    
+    def _numpy_columns(self):
+        
+        # Parquetと同じ列名で、欠損値は数値をNaN/-1、文字列を空文字で表す
+        columns = self.columns
+        return {
+            "image_id": np.array(columns["image_id"], dtype=str),
+            "index": np.array(columns["index"], dtype=np.int32),
+            "class": np.array([value or "" for value in columns["class"]], dtype=str),
+            "label": np.array(columns["label"], dtype=str),
+            "score": np.array(columns["score"], dtype=np.float32),
+            "x1": np.array(columns["x1"], dtype=np.float32),
+            "y1": np.array(columns["y1"], dtype=np.float32),
+            "x2": np.array(columns["x2"], dtype=np.float32),
+            "y2": np.array(columns["y2"], dtype=np.float32),
+            "filtered": np.array(columns["filtered"], dtype=bool),
+            "matched": np.array(columns["matched"], dtype=bool),
+            "similarity": np.array([np.nan if value is None else value for value in columns["similarity"]], dtype=np.float32),
+            "paired_with": np.array([-1 if value is None else value for value in columns["paired_with"]], dtype=np.int32),
+            "barcode_verified": np.array([-1 if value is None else int(value) for value in columns["barcode_verified"]], dtype=np.int8),
+            "barcode_data": np.array([value or "" for value in columns["barcode_data"]], dtype=str)
+        }
+    
+    def flush(self):
+        
+        if self.row_count == 0:
+            return
+        
+        with recorder.stage("output.columnar"):
+            if self.pa is not None:
+                table = self.pa.table(self.columns, schema=self._parquet_schema())
+                if self._parquet_writer is None:
+                    self._parquet_writer = self.pq.ParquetWriter(self.output_path, table.schema)
+                self._parquet_writer.write_table(table)
+            else:
+                self.chunk_count += 1
+                np.savez(f"{os.path.splitext(self.output_path)[0]}-{self.chunk_count:05d}.npz", **self._numpy_columns())
+        
+        self._reset()
+    
+    def close(self):
+        
+        self.flush()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+
+
+class ResultWriter:
+    
+    def __init__(self, ndjson_path=None, columnar_path=None, row_group_size=None):
+        
+        # 画像ごとに結果を追記し、全画像の結果をメモリに保持しない
+        self.ndjson_file = None
+        self.columnar_writer = None
+        
+        if ndjson_path:
+            os.makedirs(os.path.dirname(ndjson_path) or ".", exist_ok=True)
+            self.ndjson_file = open(ndjson_path, 'w', encoding='utf-8')
+        if columnar_path:
+            self.columnar_writer = ColumnarWriter(columnar_path, row_group_size=row_group_size)
+    
+    def write(self, image_id, results):
+        
+        if self.ndjson_file is not None:
+            # 1行 = 1オブジェクト、画像ごとにフラッシュ
+            with recorder.stage("output.ndjson"):
+                for record in results:
+                    self.ndjson_file.write(json.dumps({"image_id": image_id, **record}, ensure_ascii=False))
+                    self.ndjson_file.write("\n")
+                self.ndjson_file.flush()
+        
+        if self.columnar_writer is not None:
+            self.columnar_writer.write(image_id, results)
+    
+    def close(self):
+        
+        if self.ndjson_file is not None:
+            self.ndjson_file.close()
+            self.ndjson_file = None
+        if self.columnar_writer is not None:
+            self.columnar_writer.close()
+            self.columnar_writer = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,287 @@
+import os
+import json
+import shutil
+import logging
+import numpy as np
+from detection_set import DetectionSet, FullResolutionSource, PRODUCT, TAG
+from perf import recorder
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisSession:
+    
+    def __init__(self, detections, pairing_result, product_embeddings,
+                 siglip_classifier, barcode_reader, product_registry, tag_barcodes=None):
+        
+        self.detections = detections
+        self.pairing_result = pairing_result
+        self.siglip_classifier = siglip_classifier
+        self.barcode_reader = barcode_reader
+        self.product_registry = product_registry
+        
+        self.filtered_rows = np.flatnonzero(detections.filtered)
+        self.product_rows = detections.rows(PRODUCT)
+        self.tag_rows = detections.rows(TAG)
+        
+        # product_rowsと同じ順序の埋め込み (商品数, 次元)
+        self.product_embeddings = product_embeddings
+        
+        # タグの行 → ペアの商品の行（最初に見つかったペアを優先）
+        self.paired_product_by_tag = np.full(len(detections), -1, dtype=np.int32)
+        pairs = pairing_result['pairs']
+        if len(pairs) > 0:
+            tag_rows, first = np.unique(pairs[:, 1], return_index=True)
+            self.paired_product_by_tag[tag_rows] = pairs[first, 0]
+        
+        # 読み取り済みのJANコード（タグの行 → JANコード、読み取り失敗もNoneとして保持）
+        self.tag_barcodes = dict(tag_barcodes) if tag_barcodes else {}
+        self.reference_embeddings = {}
+    
+    def _reference_embedding(self, product_name):
+        
+        if product_name not in self.reference_embeddings:
+            reference_image_path = self.product_registry[product_name]['image_path']
+            with recorder.stage("match.reference"):
+                self.reference_embeddings[product_name] = self.siglip_classifier.encode_images([reference_image_path])[0]
+        return self.reference_embeddings[product_name]
+    
+    def _tag_barcode(self, tag_row):
+        
+        if tag_row not in self.tag_barcodes:
+            # バーコードは細部が必要なため元解像度から切り出す
+            self.tag_barcodes[tag_row] = self.barcode_reader.read_barcode(
+                self.detections.crop(tag_row, full_resolution=True)
+            )
+        else:
+            recorder.count("barcode_cache_hits")
+            logger.info("    読み取り済みのJANコードを使用: %s", self.tag_barcodes[tag_row])
+        return self.tag_barcodes[tag_row]
+    
+    def _matched_item(self, row, similarity):
+        
+        item = self.detections.item(row)
+        item['similarity'] = similarity
+        return item
+    
+    def search(self, product_name=None):
+        
+        detections = self.detections
+        pair_index = detections.pair_index
+        
+        # 検証結果（行ごと、未検証はNone）
+        barcode_verified = {}
+        barcode_data = {}
+        
+        # 特定商品の検索が指定されている場合、埋め込みの類似度で商品マッチング
+        matched_products = []
+        similarity_by_row = {}
+        if product_name:
+            logger.info("\nproductクラス(%d個)から '%s' を検索中...", len(self.product_rows), product_name)
+            
+            if product_name not in self.product_registry:
+                logger.warning("    警告: '%s'は登録されていません", product_name)
+            else:
+                reference_embedding = self._reference_embedding(product_name)
+                with recorder.stage("match"):
+                    similarities = self.product_embeddings @ reference_embedding
+                    is_match = similarities >= self.siglip_classifier.match_threshold
+                similarity_by_row = dict(zip(self.product_rows.tolist(), similarities.tolist()))
+                
+                if logger.isEnabledFor(logging.DEBUG):
+                    for row, similarity, matched in zip(self.product_rows, similarities, is_match):
+                        logger.debug("[%d] %s (類似度: %.3f)", row + 1, '✓ 一致' if matched else '✗ 不一致', similarity)
+                
+                matched_products = [
+                    self._matched_item(row, float(similarity))
+                    for row, similarity in zip(self.product_rows[is_match], similarities[is_match])
+                ]
+                
+                logger.info("\n検索結果: %d個の一致する商品が見つかりました", len(matched_products))
+                
+                # 一致した商品のタグからバーコードを検証
+                if matched_products:
+                    logger.info("\n一致した商品のバーコード検証を開始...")
+                for item in matched_products:
+                    row = item['index'] - 1
+                    tag_row = int(pair_index[row])
+                    
+                    if tag_row >= 0:
+                        logger.info("\n商品#%dのペアタグ#%dを検証中...", row + 1, tag_row + 1)
+                        detected_barcode = self._tag_barcode(tag_row)
+                        if detected_barcode is None:
+                            verified = False
+                        else:
+                            verified, detected_barcode = self.barcode_reader.verify_barcode(detected_barcode, product_name)
+                        
+                        # 検証結果を保存（タグの情報も更新）
+                        barcode_verified[row] = barcode_verified[tag_row] = verified
+                        barcode_data[row] = barcode_data[tag_row] = detected_barcode
+                    else:
+                        logger.info("\n商品#%d: ペアのタグが見つかりませんでした", row + 1)
+                    
+                    item['barcode_verified'] = barcode_verified.get(row)
+                    item['barcode_data'] = barcode_data.get(row)
+        
+        matched_rows = {item['index'] - 1 for item in matched_products}
+        results = []
+        
+        # 全件に座標とスコアを付ける（列形式の出力・集計用）
+        boxes = detections.boxes.tolist()
+        scores = detections.scores.tolist()
+        
+        # 除外されたオブジェクトを結果に追加
+        width_ratios = detections.width_ratios
+        height_ratios = detections.height_ratios
+        for row in self.filtered_rows:
+            results.append({
+                "index": int(row) + 1,
+                "class": detections.class_name(row),
+                "label": detections.label(row),
+                "box": boxes[row],
+                "score": scores[row],
+                "filtered": True,
+                "width_ratio": float(width_ratios[row]),
+                "height_ratio": float(height_ratios[row]),
+                "matched": False,
+                "similarity": None,
+                "paired_with": None,
+                "barcode_verified": None,
+                "barcode_data": None
+            })
+        
+        # ペアリング情報を含めてタグを追加
+        for row in self.tag_rows:
+            paired_product = int(self.paired_product_by_tag[row])
+            results.append({
+                "index": int(row) + 1,
+                "class": "tag",
+                "label": detections.label(row),
+                "box": boxes[row],
+                "score": scores[row],
+                "filtered": False,
+                "matched": False,
+                "similarity": None,
+                "paired_with": paired_product + 1 if paired_product >= 0 else None,
+                "barcode_verified": barcode_verified.get(row),
+                "barcode_data": barcode_data.get(row)
+            })
+        
+        # 商品を追加（ペアリング情報とバーコード検証結果を含む）
+        for row in self.product_rows:
+            paired_tag = int(pair_index[row])
+            results.append({
+                "index": int(row) + 1,
+                "class": "product",
+                "label": detections.label(row),
+                "box": boxes[row],
+                "score": scores[row],
+                "filtered": False,
+                "matched": int(row) in matched_rows,
+                "similarity": similarity_by_row.get(int(row)),
+                "paired_with": paired_tag + 1 if paired_tag >= 0 else None,
+                "barcode_verified": barcode_verified.get(row),
+                "barcode_data": barcode_data.get(row)
+            })
+        
+        logger.info(
+            "\n全%d個のオブジェクトの処理が完了(product: %d個, tag: %d個)",
+            len(results), len(self.product_rows), len(self.tag_rows)
+        )
+        
+        return results, matched_products, self.pairing_result
+    
+    def save(self, session_dir):
+        
+        os.makedirs(session_dir, exist_ok=True)
+        
+        # 共有の出力先の切り出しは次回の実行で同じ名前に上書きされるため、
+        # 今後の検索で必要になる切り出し（JANコード未読み取りのタグ）をセッション内にコピー
+        crop_dir = os.path.join(session_dir, 'crops')
+        os.makedirs(crop_dir, exist_ok=True)
+        filepaths = [None] * len(self.detections)
+        for row in self.tag_rows:
+            if int(row) in self.tag_barcodes:
+                continue
+            filename = f"tag_{row + 1:03d}.png"
+            destination = os.path.join(crop_dir, filename)
+            # 再開したセッションを同じディレクトリに保存する場合はコピー済み
+            if os.path.abspath(self.detections.filepaths[row]) != os.path.abspath(destination):
+                shutil.copyfile(self.detections.filepaths[row], destination)
+            # session_dirからの相対パスで保存（ディレクトリごと移動しても読み込める）
+            filepaths[row] = os.path.join('crops', filename)
+        
+        # 配列はnpz、文字列などはJSONで保存
+        np.savez(
+            os.path.join(session_dir, 'detections.npz'),
+            product_embeddings=self.product_embeddings,
+            **self.detections.to_arrays()
+        )
+        
+        session_data = {
+            'label_names': self.detections.label_names,
+            'filepaths': filepaths,
+            'image_size': list(self.detections.image_size),
+            # 再開後も元解像度からJANコードを読み取れるように元画像の参照を保存
+            'full_resolution': (
+                self.detections.full_resolution.to_dict() if self.detections.full_resolution is not None else None
+            ),
+            'tag_barcodes': [[int(row), barcode] for row, barcode in self.tag_barcodes.items()]
+        }
+        
+        with open(os.path.join(session_dir, 'session.json'), 'w', encoding='utf-8') as f:
+            json.dump(session_data, f, ensure_ascii=False, indent=2)
+        
+        logger.info("セッションを保存: %s", session_dir)
+    
+    @classmethod
+    def load(cls, session_dir, siglip_classifier, barcode_reader, product_registry):
+        
+        with open(os.path.join(session_dir, 'session.json'), 'r', encoding='utf-8') as f:
+            session_data = json.load(f)
+        arrays = dict(np.load(os.path.join(session_dir, 'detections.npz')))
+        product_embeddings = arrays.pop('product_embeddings')
+        
+        # 画像は保持しないため、切り出しはセッション内にコピーしたファイルから読み込む
+        filepaths = [
+            os.path.join(session_dir, filepath) if filepath else None
+            for filepath in session_data['filepaths']
+        ]
+        # 元画像が変わっていなければ、ライブのセッションと同じく元解像度から切り出す
+        full_resolution = None
+        source = session_data.get('full_resolution')
+        if source:
+            full_resolution = FullResolutionSource.from_dict(source)
+            if full_resolution is None:
+                logger.warning("元画像が見つからないか変更されているため、保存済みの切り出しからJANコードを読み取ります: %s", source['image_path'])
+        
+        detections = DetectionSet.from_arrays(
+            arrays,
+            session_data['label_names'],
+            filepaths=filepaths,
+            image_size=tuple(session_data['image_size']),
+            full_resolution=full_resolution
+        )
+        
+        # ペアリング結果を行の配列から復元
+        product_rows = detections.rows(PRODUCT)
+        paired = detections.pair_index[product_rows] >= 0
+        paired_rows = product_rows[paired]
+        pairing_result = {
+            'pairs': np.stack([paired_rows, detections.pair_index[paired_rows]], axis=1).astype(np.int32),
+            'distances': detections.pair_distance[paired_rows],
+            'unpaired_products': product_rows[~paired],
+            'unpaired_tags': np.setdiff1d(detections.rows(TAG), detections.pair_index[paired_rows])
+        }
+        
+        logger.info("セッションを読み込み: %s", session_dir)
+        
+        return cls(
+            detections,
+            pairing_result,
+            product_embeddings,
+            siglip_classifier,
+            barcode_reader,
+            product_registry,
+            tag_barcodes={row: barcode for row, barcode in session_data['tag_barcodes']}
+        )
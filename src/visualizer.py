@@ -1,6 +1,17 @@
-from PIL import ImageDraw, ImageFont
-import matplotlib.pyplot as plt
+import cv2
+import logging
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
 from collections import Counter
+from perf import recorder
+
+logger = logging.getLogger(__name__)
+
+
+# 描画色（OpenCVのBGR順）
+DETECTION_COLOR = (0, 0, 255)
+MATCHED_COLOR = (0, 255, 0)
+FILTERED_COLOR = (160, 160, 160)
 
 
 class Visualizer:
@@ -9,6 +20,86 @@ class Visualizer:
         # フォントの設定
         self.font = ImageFont.load_default()
     
+    def _show(self, image, title):
+        
+        # matplotlibは表示する場合のみ読み込む（起動時間の短縮）
+        import matplotlib.pyplot as plt
+        
+        plt.figure(figsize=(15, 10))
+        plt.imshow(image)
+        plt.axis('off')
+        plt.title(title)
+        plt.tight_layout()
+        plt.show()
+    
+    def _draw_box(self, canvas, box, text, color, thickness):
+        
+        x1, y1, x2, y2 = box
+        cv2.rectangle(canvas, (x1, y1), (x2, y2), color, thickness)
+        
+        # テキストの背景を描画
+        (text_width, text_height), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+        cv2.rectangle(canvas, (x1, y1), (x1 + text_width, y1 + text_height + baseline), color, -1)
+        cv2.putText(canvas, text, (x1, y1 + text_height), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1, cv2.LINE_AA)
+    
+    def render(self, detections, matched_items=None, save_path=None, max_size=None, show=False, quality=None, image=None):
+        
+        if quality is None:
+            quality = 90
+        if matched_items is None:
+            matched_items = []
+        
+        # 描画する画像（省略時は検出結果の共有バッファ、パス・PIL画像・RGB配列も指定可能）
+        if image is None:
+            image = detections.image
+        if image is None:
+            raise ValueError("描画する画像がありません（元画像を解放済み、または画像を持たない検出結果です）。imageに画像を指定してください")
+        if isinstance(image, str):
+            image = Image.open(image).convert("RGB")
+        image = np.asarray(image)
+        
+        with recorder.stage("visualize.draw"):
+            # 共有バッファから直接、描画用の画像を1枚だけ作る（縮小する場合は先に縮小して描画）
+            height, width = image.shape[:2]
+            scale = width / detections.image_size[0]
+            if max_size is not None and max(width, height) > max_size:
+                resize = max_size / max(width, height)
+                scale *= resize
+                canvas = cv2.resize(image, (round(width * resize), round(height * resize)), interpolation=cv2.INTER_AREA)
+                cv2.cvtColor(canvas, cv2.COLOR_RGB2BGR, dst=canvas)
+            else:
+                canvas = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+            
+            boxes = np.round(detections.boxes * scale).astype(np.int32)
+            thickness = max(1, round(5 * scale))
+            matched_rows = {item['index'] - 1 for item in matched_items}
+            
+            # 全検出結果（除外されたものは灰色）
+            for row in range(len(detections)):
+                if row in matched_rows:
+                    continue
+                color = FILTERED_COLOR if detections.filtered[row] else DETECTION_COLOR
+                self._draw_box(canvas, boxes[row], f"{row+1}: {detections.label(row)} ({detections.scores[row]:.2f})", color, thickness)
+            
+            # 一致した商品を最前面に描画
+            for item in matched_items:
+                self._draw_box(canvas, boxes[item['index'] - 1], f"#{item['index']}: {item['label']} ({item['score']:.2f})", MATCHED_COLOR, thickness)
+        
+        # 保存
+        if save_path:
+            with recorder.stage("visualize.save"):
+                cv2.imwrite(save_path, canvas, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            logger.info("検出結果を保存しました: %s (%dx%d)", save_path, canvas.shape[1], canvas.shape[0])
+        
+        # 結果を表示
+        if show:
+            self._show(
+                cv2.cvtColor(canvas, cv2.COLOR_BGR2RGB),
+                f"検出された物体数: {len(detections)}, 一致した商品: {len(matched_items)}個"
+            )
+        
+        return canvas
+    
     def visualize_results(self, results, save_path=None, show=False):
         
         image = results["image"].copy()
@@ -37,24 +128,20 @@ class Visualizer:
         
         # 結果を表示
         if show:
-            plt.figure(figsize=(15, 10))
-            plt.imshow(image)
-            plt.axis('off')
-            plt.title(f"検出された物体数: {len(results['boxes'])}")
-            plt.tight_layout()
-            plt.show()
+            self._show(image, f"検出された物体数: {len(results['boxes'])}")
         
         # 保存
         if save_path:
-            image.save(save_path)
-            print(f"検出結果を保存しました: {save_path}")
+            with recorder.stage("visualize.save"):
+                image.save(save_path)
+            logger.info("検出結果を保存しました: %s", save_path)
         
         return image
     
     def visualize_matched_products(self, results, matched_items, save_path=None, show=False):
         
         if not matched_items:
-            print("一致した商品がないため、可視化をスキップ")
+            logger.info("一致した商品がないため、可視化をスキップ")
             return None
         
         image = results["image"].copy()
@@ -80,35 +167,31 @@ class Visualizer:
         
         # 結果を表示
         if show:
-            plt.figure(figsize=(15, 10))
-            plt.imshow(image)
-            plt.axis('off')
-            plt.title(f"一致した商品: {len(matched_items)}個")
-            plt.tight_layout()
-            plt.show()
+            self._show(image, f"一致した商品: {len(matched_items)}個")
         
         # 保存
         if save_path:
-            image.save(save_path)
-            print(f"一致した商品の検出結果を保存しました: {save_path}")
+            with recorder.stage("visualize.save"):
+                image.save(save_path)
+            logger.info("一致した商品の検出結果を保存しました: %s", save_path)
         
         return image
     
     def print_detection_summary(self, results):
         
-        print(f"検出結果サマリー")
-        print(f"検出された物体数: {len(results['boxes'])}")
+        logger.info("検出結果サマリー")
+        logger.info("検出された物体数: %d", len(results['boxes']))
         
         # ラベルごとの検出数を集計
         label_counts = Counter(results['labels'])
         
-        print(f"\nラベルごとの検出数:")
+        logger.info("\nラベルごとの検出数:")
         for label, count in sorted(label_counts.items(), key=lambda x: x[1], reverse=True):
-            print(f"  {label}: {count}個")
+            logger.info("  %s: %d個", label, count)
     
     def print_summary(self, vlm_results):
-
-        print(f"\n処理結果サマリー")
+        
+        logger.info("\n処理結果サマリー")
         
         product_count = sum(1 for r in vlm_results if r.get('class') == 'product')
         tag_count = sum(1 for r in vlm_results if r.get('class') == 'tag')
@@ -128,14 +211,14 @@ class Visualizer:
                                    and r.get('matched') == True 
                                    and r.get('barcode_verified') is None)
         
-        print(f"処理したオブジェクト数: {len(vlm_results)}個")
-        print(f"  product: {product_count}個")
-        print(f"  tag: {tag_count}個")
+        logger.info("処理したオブジェクト数: %d個", len(vlm_results))
+        logger.info("  product: %d個", product_count)
+        logger.info("  tag: %d個", tag_count)
         if matched_count > 0:
-            print(f"一致した商品: {matched_count}個")
+            logger.info("一致した商品: %d個", matched_count)
             if barcode_verified_count > 0:
-                print(f"  バーコード検証成功: {barcode_verified_count}個")
+                logger.info("  バーコード検証成功: %d個", barcode_verified_count)
             if barcode_failed_count > 0:
-                print(f"  バーコード検証失敗: {barcode_failed_count}個")
+                logger.info("  バーコード検証失敗: %d個", barcode_failed_count)
             if barcode_no_tag_count > 0:
-                print(f"  バーコード未検証(タグなし): {barcode_no_tag_count}個")
+                logger.info("  バーコード未検証(タグなし): %d個", barcode_no_tag_count)